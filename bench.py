@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+#
+# Runs the handlers in main.py against App Engine's local service stubs and
+# a fake orac, and reports latency percentiles and backend calls for each
+# endpoint.
+#
+#     python bench.py --sdk ~/google_appengine --users 2000 --problems 2000
+#
+# Before that, pairs of users race on several threads to claim and sync as
+# the same usernames, to check nothing is lost or claimed twice when many
+# users sync at once.
+#
+import BaseHTTPServer
+import Queue
+import SocketServer
+import argparse
+import datetime
+import os
+import random
+import sys
+import threading
+import time
+import urllib
+
+CATEGORIES = ['memcache', 'datastore', 'http', 'parse', 'taskqueue']
+
+def hub_row(prob_id, name, result, solve_date):
+    if result == 100:
+        status = 'Finished on %s, 12:00' % solve_date.strftime('%a %d %b %Y')
+    elif result == 0:
+        status = 'New'
+    else:
+        status = '%d%% (Attempted)' % result
+    return '<tr><td><a href="problem.pl?set=s%d&problemid=%d">%s</a></td><td class="status"> %s </td></tr>\n' % (
+        prob_id % 20, prob_id, name, status)
+
+class Dataset(object):
+    # a made-up site: problems, users, and each user's results
+    def __init__(self, users, problems, per_user, seed=0, prefix='user'):
+        rng = random.Random(seed)
+        self.names = dict([(prob_id, 'Problem %d' % prob_id) for prob_id in xrange(1, problems+1)])
+        self.usernames = ['%s%d' % (prefix, i) for i in xrange(users)]
+        self.results = dict()
+        for username in self.usernames:
+            stats = dict()
+            for prob_id in rng.sample(self.names.keys(), min(per_user, problems)):
+                result = rng.choice([0, 0, 100, 100, 100, rng.randint(1, 99)])
+                solve_date = datetime.date(2012, 1, 1) + datetime.timedelta(days=rng.randint(0, 365)) if result == 100 else None
+                stats[prob_id] = (self.names[prob_id], result, solve_date)
+            self.results[username] = stats
+
+    def progress(self, username, rng):
+        # pretends the user has made progress on a few problems since
+        stats = dict(self.results[username])
+        for prob_id in rng.sample(stats.keys(), min(3, len(stats))):
+            name, result, solve_date = stats[prob_id]
+            # orac keeps the date a problem was first finished
+            stats[prob_id] = (name, 100, solve_date or datetime.date(2013, 1, 1))
+        self.results[username] = stats
+
+    def hub(self, username):
+        stats = self.results[username]
+        return ''.join([hub_row(prob_id, name, result, solve_date) for prob_id, (name, result, solve_date) in sorted(stats.items())])
+
+class FakeOrac(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # serves the login form and hub page like orac does, for the users in a
+    # dataset; every password is 'password'
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, dataset):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeOracHandler)
+        self.dataset = dataset
+        self.requests = 0
+        self.connections = 0
+
+    def process_request_thread(self, request, client_address):
+        self.connections += 1
+        SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+
+    @property
+    def host(self):
+        return '127.0.0.1:%d' % self.server_port
+
+class FakeOracHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in one go; written a header at a time, Nagle's
+    # algorithm holds up every response on a kept-alive connection
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.server.requests += 1
+        params = dict([pair.split('=', 1) for pair in self.rfile.read(int(self.headers.get('Content-Length', 0))).split('&')])
+        username = urllib.unquote_plus(params.get('login_username', ''))
+        ok = username in self.server.dataset.results and params.get('login_password') == 'password'
+        self.send_response(302)
+        self.send_header('Location', '/cgi-bin/train/hub.pl' if ok else '/cgi-bin/train/index.pl?error=1')
+        if ok:
+            self.send_header('Set-Cookie', 'aioc_session=%s; path=/' % username)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests += 1
+        cookie = self.headers.get('Cookie', '')
+        username = cookie.split('=', 1)[1] if cookie.startswith('aioc_session=') else None
+        if username not in self.server.dataset.results:
+            self.send_response(302)
+            self.send_header('Location', '/cgi-bin/train/index.pl')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        page = self.server.dataset.hub(username)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+def race(app, dataset, user_for, threads):
+    # two users at once try to claim each of the dataset's usernames and
+    # sync as it, across several threads; checks that every username ends up
+    # with exactly one owner and every problem and aggregate is complete, and
+    # returns the datastore calls made by each claim and sync
+    import instrument
+    work = Queue.Queue()
+    for username in dataset.usernames:
+        for contender in ('a', 'b'):
+            work.put((username, contender))
+    results = list()
+    failures = list()
+
+    def retried(func, *args):
+        # retries like the task queue does a failed sync, so contention
+        # only counts as a failure if it outlasts the retries
+        for attempt in xrange(app.SYNC_RETRY_LIMIT):
+            try:
+                return func(*args)
+            except Exception:
+                time.sleep(random.uniform(0, 0.1 * 2**attempt))
+        return func(*args)
+
+    def worker():
+        while True:
+            try:
+                username, contender = work.get_nowait()
+            except Queue.Empty:
+                return
+            app.memo.clear()
+            instrument.timings.clear()
+            user = user_for(contender + username)
+            try:
+                won = retried(app.reserve_username, username, user)
+                if won:
+                    retried(app.apply_stats, user, username, dataset.results[username])
+            except Exception, e:
+                failures.append('%s/%s: %r' % (username, contender, e))
+                continue
+            results.append((username, user.user_id(), won, instrument.timings.counts.get('datastore', 0)))
+
+    workers = [threading.Thread(target=worker) for _ in xrange(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    app.memo.clear()
+
+    winners = dict()
+    for username, user_id, won, _ in results:
+        if won:
+            if username in winners:
+                failures.append('%s claimed twice' % username)
+            winners[username] = user_id
+    for username in dataset.usernames:
+        reservation = app.UsernameReservation.get_by_key_name(username)
+        if username not in winners or not reservation or reservation.owner.user_id() != winners[username]:
+            failures.append('%s not held by its winner' % username)
+
+    holders = dict()
+    for username in winners:
+        for prob_id in dataset.results[username]:
+            holders.setdefault(prob_id, set()).add(winners[username])
+    prob_ids = sorted(holders)
+    for prob_id, problem in zip(prob_ids, app.Problem.get_by_key_name([app.problem_key_name(prob_id) for prob_id in prob_ids])):
+        if not problem:
+            failures.append('problem %d missing' % prob_id)
+        stats = app.load_problem_stats(prob_id)
+        if not stats or stats.solved + stats.unsolved + stats.unattempted != len(holders[prob_id]):
+            failures.append('problem %d aggregate incomplete' % prob_id)
+
+    return [calls for _, _, won, calls in results if won], [calls for _, _, won, calls in results if not won], failures
+
+def setup_sdk(sdk):
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    os.environ['APPENGINE_RUNTIME'] = 'python27'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sdk', help='path to the App Engine SDK')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--problems', type=int, default=2000)
+    parser.add_argument('--per-user', type=int, default=60, help='problems each user has')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--racers', type=int, default=100, help='usernames two users race to claim and sync, first')
+    parser.add_argument('--threads', type=int, default=8, help='threads racing')
+    args = parser.parse_args()
+
+    setup_sdk(args.sdk)
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # a consistency policy like the real datastore's
+    bed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=0.5, seed=args.seed))
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+    bed.init_urlfetch_stub()
+
+    # main has to be imported once the stubs are in place, so its hooks
+    # are installed on them
+    import main as app
+    import stats
+
+    dataset = Dataset(args.users, args.problems, args.per_user, args.seed)
+    orac = FakeOrac(dataset)
+    thread = threading.Thread(target=orac.serve_forever)
+    thread.daemon = True
+    thread.start()
+    stats.client.host = orac.host
+    try:
+        run(args, bed, app, dataset, orac)
+    finally:
+        orac.shutdown()
+        orac.server_close()
+        bed.deactivate()
+
+def run(args, bed, app, dataset, orac):
+    import instrument
+    import jobs
+    from google.appengine.api import users
+    from google.appengine.datastore import datastore_stub_util
+
+    runner = jobs.LocalRunner(min_backoff=0)
+    runner.register('/_tasks/sync', app.run_sync)
+    app.runner = runner
+
+    wsgi = app.app
+
+    # the datastore stub replaces the user id of every User it stores with
+    # one made from the email address, so users are given that id to begin
+    # with
+    def user_for(username):
+        email = username + '@example.com'
+        return users.User(email, _user_id=datastore_stub_util.SynthesizeUserId(email))
+
+    def log_in(username):
+        email = username + '@example.com'
+        bed.setup_env(overwrite=True, user_email=email, user_id=datastore_stub_util.SynthesizeUserId(email), user_is_admin='0')
+
+    if args.racers:
+        racers = Dataset(args.racers, args.problems, args.per_user, args.seed + 1, prefix='racer')
+        sys.stderr.write('Racing %d users for %d usernames on %d threads...\n' % (2*args.racers, args.racers, args.threads))
+        won, lost, failures = race(app, racers, user_for, args.threads)
+        for failure in failures:
+            sys.stderr.write(failure + '\n')
+        print 'race: %d failures; datastore calls per sync %.1f, per refused claim %.1f' % (len(failures),
+            sum(won)/float(len(won) or 1), sum(lost)/float(len(lost) or 1))
+        print
+
+    sys.stderr.write('Loading %d users...\n' % args.users)
+    start = time.time()
+    for username in dataset.usernames:
+        log_in(username)
+        app.apply_stats(user_for(username), username, dataset.results[username])
+    sys.stderr.write('Loaded in %.1fs\n' % (time.time() - start))
+
+    from webapp2 import Request
+
+    rng = random.Random(args.seed)
+    endpoints = [
+        ('home', lambda username: Request.blank('/')),
+        ('problems', lambda username: Request.blank('/problems')),
+        ('problem', lambda username: Request.blank('/problem/%d' % rng.choice(dataset.results[username].keys()))),
+        ('compare', lambda username: Request.blank('/compare?them=%s' % rng.choice(dataset.usernames))),
+        ('leaderboard', lambda username: Request.blank('/leaderboard')),
+        ('update', lambda username: Request.blank('/update', POST={'username': username, 'password': 'password'})),
+    ]
+
+    print '%-12s %6s %9s %9s %9s  %s' % ('endpoint', 'n', 'p50 ms', 'p95 ms', 'p99 ms', '  '.join(['%16s' % c for c in CATEGORIES]))
+    for name, make_request in endpoints:
+        instrument.history.clear()
+        latencies = list()
+        for _ in xrange(args.requests):
+            username = rng.choice(dataset.usernames)
+            log_in(username)
+            if name == 'update':
+                dataset.progress(username, rng)
+            request = make_request(username)
+            start = time.time()
+            response = request.get_response(wsgi)
+            latencies.append((time.time() - start) * 1000)
+            if response.status_int >= 400:
+                sys.stderr.write('%s: %s\n' % (request.path_qs, response.status))
+
+        calls = dict([(category, [0, 0.0]) for category in CATEGORIES])
+        for _, _, _, counts, times in instrument.history:
+            for category in CATEGORIES:
+                calls[category][0] += counts.get(category, 0)
+                calls[category][1] += times.get(category, 0)
+        n = float(len(instrument.history))
+        columns = ['%6.1f / %6.1fms' % (calls[c][0]/n, calls[c][1]/n) for c in CATEGORIES]
+        print '%-12s %6d %9.1f %9.1f %9.1f  %s' % (name, len(latencies),
+            instrument.percentile(latencies, 50), instrument.percentile(latencies, 95), instrument.percentile(latencies, 99),
+            '  '.join(columns))
+
+    print
+    print 'fake orac: %d requests over %d connections' % (orac.requests, orac.connections)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+
+# seconds a value lives in memcache
+DEFAULT_TTL = 24*60*60
+# seconds a value lives in the in-process tier, for keys that ask for it;
+# this is how stale a hot key can get on other instances after a change
+LOCAL_TTL = 10
+LOCAL_SIZE = 200
+# a loader gets this many seconds to fill a key before others stop waiting
+LEASE_TTL = 10
+LEASE_WAIT = 0.05
+LEASE_TRIES = 20
+
+GENERATION_PREFIX = 'gen-'
+# stored under a key while someone is loading it
+LEASE = '__lease__'
+
+class LRUCache(object):
+    # a small in-process cache in front of memcache, shared between threads
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                return None
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + ttl)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+local = LRUCache(LOCAL_SIZE)
+
+def generation(namespace):
+    # the current generation of a namespace; every key in the namespace is
+    # stored under its generation, so bumping it invalidates them all at once
+    # and a stale value can never be written over a fresh one
+    gen = memcache.get(GENERATION_PREFIX + namespace)
+    if gen is None:
+        return bump(namespace)
+    return gen
+
+def bump(namespace):
+    # starting from the time means a namespace that falls out of memcache
+    # can't come back on a generation that's been used before
+    return memcache.incr(GENERATION_PREFIX + namespace, initial_value=int(time.time()*1000))
+
+def versioned(key, namespace):
+    if namespace is None:
+        return key
+    return '%s@%s' % (key, generation(namespace))
+
+def versioned_multi(keys, namespaces):
+    # like versioned, but for many keys at once
+    gen_keys = [GENERATION_PREFIX + namespace for namespace in namespaces]
+    gens = memcache.get_multi(gen_keys)
+    result = list()
+    for key, namespace, gen_key in zip(keys, namespaces, gen_keys):
+        if gen_key not in gens:
+            gens[gen_key] = bump(namespace)
+        result.append('%s@%s' % (key, gens[gen_key]))
+    return result
+
+def is_lease(value):
+    return isinstance(value, str) and value == LEASE
+
+def get(key, loader, ttl=DEFAULT_TTL, namespace=None, local_ttl=None):
+    # returns the cached value for key, calling loader to fill it on a miss;
+    # only one caller at a time runs the loader for a key, while the rest
+    # wait for it to finish
+    key = versioned(key, namespace)
+    if local_ttl:
+        value = local.get(key)
+        if value is not None:
+            return value
+
+    value = memcache.get(key)
+    if value is None or is_lease(value):
+        value = load(key, loader, ttl)
+    if local_ttl and value is not None:
+        local.set(key, value, local_ttl)
+    return value
+
+def load(key, loader, ttl):
+    # the loader takes a lease by putting LEASE in the key itself, and only
+    # fills the key if it still holds the lease; a set or delete in the
+    # meantime (from a writer that knows better) takes the lease away, so a
+    # loader that read before the write can't put its stale value over it
+    client = memcache.Client()
+    for _ in xrange(LEASE_TRIES):
+        if memcache.add(key, LEASE, LEASE_TTL):
+            value = client.gets(key)
+            if value is not None and not is_lease(value):
+                # written since the lease was taken
+                return value
+            filled = False
+            try:
+                value = loader()
+                if value is not None and client.cas(key, value, ttl):
+                    filled = True
+            finally:
+                if not filled and is_lease(memcache.get(key)):
+                    memcache.delete(key)
+            return value
+
+        # someone else holds the lease, so wait for them
+        time.sleep(LEASE_WAIT)
+        value = memcache.get(key)
+        if value is not None and not is_lease(value):
+            return value
+    return loader()
+
+def get_multi(keys, loader, ttl=DEFAULT_TTL):
+    # returns a dict of the cached values for keys; loader is called with
+    # the keys that missed and returns a dict of their values, which only
+    # fill keys that are still empty, so they can't replace anything
+    # written through in the meantime
+    cached = memcache.get_multi(keys)
+    missing = [key for key in keys if key not in cached or is_lease(cached[key])]
+    if missing:
+        loaded = loader(missing)
+        memcache.add_multi(loaded, ttl)
+        cached.update(loaded)
+    return cached
+
+def set(key, value, ttl=DEFAULT_TTL, namespace=None):
+    key = versioned(key, namespace)
+    memcache.set(key, value, ttl)
+    local.delete(key)
+
+def delete(key):
+    memcache.delete(key)
+    local.delete(key)
+
+def delete_multi(keys):
+    memcache.delete_multi(keys)
+    for key in keys:
+        local.delete(key)
@@ -0,0 +1,163 @@
+import collections
+import re
+import threading
+import time
+
+# what each App Engine API service's calls are counted as
+SERVICES = {
+    'memcache': 'memcache',
+    'datastore_v3': 'datastore',
+    'urlfetch': 'http',
+    'taskqueue': 'taskqueue',
+}
+
+# how many finished requests each instance remembers for /_stats
+HISTORY_SIZE = 500
+
+class Recorder(object):
+    # the number of calls made and milliseconds spent in each category while
+    # handling a request, added to by every thread working on it
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.defaultdict(int)
+        self.times = collections.defaultdict(float)
+        # start times of calls that are timed by their post-call hook
+        self.pending = dict()
+
+    def add(self, category, ms):
+        with self.lock:
+            self.counts[category] += 1
+            self.times[category] += ms
+
+class RequestTimings(threading.local):
+    # the recorder for the request the current thread is working on; a
+    # thread that does work for a request, like the fetch_many workers,
+    # joins the request's recorder so its calls are counted too
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.recorder = Recorder()
+
+    def share(self):
+        return self.recorder
+
+    def join(self, recorder):
+        self.recorder = recorder
+
+    def add(self, category, ms):
+        self.recorder.add(category, ms)
+
+    @property
+    def counts(self):
+        return self.recorder.counts
+
+    @property
+    def times(self):
+        return self.recorder.times
+
+timings = RequestTimings()
+history = collections.deque(maxlen=HISTORY_SIZE)
+history_lock = threading.Lock()
+
+class timed(object):
+    # times a block of code that isn't an API call, e.g.
+    #     with timed('parse'):
+    #         ...
+    def __init__(self, category):
+        self.category = category
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        timings.add(self.category, (time.time() - self.start) * 1000)
+
+def pre_call_hook(service, call, request, response, rpc):
+    recorder = timings.recorder
+    category = SERVICES.get(service, service)
+    start = time.time()
+    if rpc is None:
+        recorder.pending[id(response)] = start
+        return
+
+    # an asynchronous call is timed to when it completes, which its RPC's
+    # callback is told about straight away, rather than to whenever its
+    # result happens to be asked for
+    callback = rpc.callback
+
+    def completed():
+        recorder.add(category, (time.time() - start) * 1000)
+        if callback:
+            callback()
+    rpc.callback = completed
+
+def post_call_hook(service, call, request, response):
+    # only calls made without an RPC are left to here
+    recorder = timings.recorder
+    start = recorder.pending.pop(id(response), None)
+    if start is not None:
+        recorder.add(SERVICES.get(service, service), (time.time() - start) * 1000)
+
+def install_hooks():
+    # times every API call the app makes
+    from google.appengine.api import apiproxy_stub_map
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('instrument', pre_call_hook)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('instrument', post_call_hook)
+
+def server_timing(total):
+    parts = ['%s;dur=%.1f;desc="%d calls"' % (category, timings.times[category], timings.counts[category])
+             for category in sorted(timings.counts)]
+    parts.append('total;dur=%.1f' % total)
+    return ', '.join(parts)
+
+class InstrumentMiddleware(object):
+    # adds a Server-Timing header to every response and remembers each
+    # request's timings for /_stats
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        timings.clear()
+        start = time.time()
+
+        def instrumented_start_response(status, headers, exc_info=None):
+            headers.append(('Server-Timing', server_timing((time.time() - start) * 1000)))
+            return start_response(status, headers, exc_info)
+
+        try:
+            return self.app(environ, instrumented_start_response)
+        finally:
+            record = (environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'), (time.time() - start) * 1000,
+                      dict(timings.counts), dict(timings.times))
+            with history_lock:
+                history.append(record)
+            timings.clear()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+def summarise():
+    # groups the remembered requests by method and path; returns a list of
+    # (method, path, requests, p50 ms, p95 ms, {category: (calls, ms)}) with
+    # the calls and ms averaged per request
+    with history_lock:
+        records = list(history)
+
+    grouped = collections.defaultdict(list)
+    for method, path, total, counts, times in records:
+        # lump together pages that only differ by id, like /problem/123
+        grouped[(method, re.sub('[0-9]+', '*', path))].append((total, counts, times))
+
+    summary = list()
+    for (method, path), rows in sorted(grouped.items()):
+        n = len(rows)
+        categories = dict()
+        for category in set([category for _, counts, _ in rows for category in counts]):
+            calls = sum([counts.get(category, 0) for _, counts, _ in rows])
+            ms = sum([times.get(category, 0) for _, _, times in rows])
+            categories[category] = (calls / float(n), ms / n)
+        totals = [total for total, _, _ in rows]
+        summary.append((method, path, n, percentile(totals, 50), percentile(totals, 95), categories))
+    return summary
@@ -0,0 +1,40 @@
+import logging
+import time
+
+class TaskQueueRunner(object):
+    # hands jobs to the App Engine task queue, which posts them back to the
+    # handler at url and retries them according to queue.yaml
+    def __init__(self, queue_name='default'):
+        self.queue_name = queue_name
+
+    def register(self, url, func):
+        pass
+
+    def enqueue(self, url, params):
+        from google.appengine.api import taskqueue
+        taskqueue.add(queue_name=self.queue_name, url=url, params=params)
+
+class LocalRunner(object):
+    # runs jobs in-process as soon as they're queued, retrying with
+    # exponential backoff like the task queue does; for running the app
+    # without App Engine or the real orac
+    def __init__(self, retry_limit=5, min_backoff=0.1, max_doublings=4):
+        self.retry_limit = retry_limit
+        self.min_backoff = min_backoff
+        self.max_doublings = max_doublings
+        self.funcs = dict()
+        self.sleep = time.sleep
+
+    def register(self, url, func):
+        self.funcs[url] = func
+
+    def enqueue(self, url, params):
+        func = self.funcs[url]
+        for attempt in xrange(self.retry_limit + 1):
+            try:
+                func(attempt=attempt, **params)
+                return
+            except Exception:
+                logging.exception('Job %s failed on attempt %d', url, attempt)
+                if attempt < self.retry_limit:
+                    self.sleep(self.min_backoff * 2**min(attempt, self.max_doublings))
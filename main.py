@@ -14,21 +14,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import webapp
 from google.appengine.ext import db
 from google.appengine.ext.webapp import template
-from google.appengine.ext.webapp import util
+import calendar
 import datetime
+import email.utils
+import hashlib
+import json
+import logging
 import os
 import pickle
 import random
 import re
-
-from stats import get_probs_stats, fetch_stats
-
-HTML_PATH = os.path.join(os.path.dirname(__file__), 'index.html')
+import time
+
+import cache
+import instrument
+import jobs
+from instrument import timed, InstrumentMiddleware
+from memo import memo, MemoMiddleware
+from scores import ScoreVector, popcount, differing_many
+from scores import SolutionRow, pack_solutions, unpack_solutions, pack_counts, unpack_counts
+from scores import pack_day_counts, unpack_day_counts, pack_nested_counts, unpack_nested_counts
+from stats import get_probs_stats, orac_login, fetch_hub, SharedRateLimiter
+from stats import client as orac_client
+from stats import fingerprint_stats, pack_fingerprints, unpack_fingerprints
+
+TEMPLATE_DIR = os.path.dirname(__file__)
+HTML_PATH = os.path.join(TEMPLATE_DIR, 'index.html')
 
 class Page(object):
     def __init__(self, title, url, filename):
@@ -39,11 +55,56 @@ class Page(object):
 HOME = Page('Home', '/', 'home.html')
 PROBLEMS = Page('Problems', '/problems', 'problems.html')
 COMPARE = Page('Compare', '/compare', 'compare.html')
+LEADERBOARD = Page('Leaderboard', '/leaderboard', 'leaderboard.html')
+PROGRESS = Page('Progress', '/progress', 'progress.html')
 UPDATE = Page('Update', '/update', 'update.html')
 
 PROBLEM = Page('', '/problem/[0-9]+', 'problem.html')
+TIMINGS = Page('Timings', '/_stats', 'timings.html')
+
+PAGES = [HOME, PROBLEMS, COMPARE, LEADERBOARD, PROGRESS, UPDATE]
+
+# templates are compiled once, when the module is loaded
+def load_template(filename):
+    return template.load(os.path.join(TEMPLATE_DIR, filename))
+
+INDEX_TEMPLATE = template.load(HTML_PATH)
+PAGE_TEMPLATES = dict([(page.filename, load_template(page.filename)) for page in PAGES + [PROBLEM, TIMINGS]])
+PROBLEM_LIST_TEMPLATE = load_template('problem_list.html')
+SOLUTIONS_TABLE_TEMPLATE = load_template('solutions_table.html')
+
+def render(compiled, template_values):
+    return compiled.render(template.Context(template_values))
+
+def write_page(handler, template_values, last_modified=None):
+    # renders the page into index.html
+    template_values['content'] = render(PAGE_TEMPLATES[template_values['page'].filename], template_values)
+    body = render(INDEX_TEMPLATE, template_values)
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    write_conditional(handler, body, 'text/html; charset=utf-8', last_modified)
+
+def write_conditional(handler, body, content_type, last_modified=None):
+    # writes body, or answers with a 304 if the client already has it
+    etag = '"%s"' % hashlib.md5(body).hexdigest()
+    handler.response.headers['ETag'] = etag
+    handler.response.headers['Cache-Control'] = 'private, max-age=0'
+    if last_modified:
+        last_modified = last_modified.replace(microsecond=0)
+        handler.response.headers['Last-Modified'] = email.utils.formatdate(calendar.timegm(last_modified.timetuple()), usegmt=True)
+
+    if_none_match = handler.request.headers.get('If-None-Match')
+    if_modified_since = handler.request.if_modified_since
+    if if_none_match:
+        not_modified = etag in [tag.strip() for tag in if_none_match.split(',')]
+    else:
+        not_modified = last_modified and if_modified_since and last_modified <= if_modified_since.replace(tzinfo=None)
+    if not_modified:
+        handler.response.set_status(304)
+        return
 
-PAGES = [HOME, PROBLEMS, COMPARE, UPDATE]
+    handler.response.headers['Content-Type'] = content_type
+    handler.response.out.write(body)
 
 def standard_template_values():
     template_values = {}
@@ -75,39 +136,207 @@ class Solution(db.Model):
     owner = db.UserProperty(required=True)
     result = db.IntegerProperty(required=True)
     solve_date = db.DateProperty()
+    # the owner's orac username and solution_result, so a problem's solvers
+    # can be listed in order straight from an index
+    username = db.StringProperty()
+    listed_result = db.IntegerProperty()
+
+class UserSolutions(db.Model):
+    # every result a user has, packed by pack_solutions, so they can all be
+    # loaded with one get; Solution entities are still written alongside it
+    # for the queries that need them
+    owner = db.UserProperty(required=True)
+    packed = db.BlobProperty()
+    # whether these solutions have been counted in DailySolves yet; only
+    # changes to counted solutions are applied to the rollups as they happen
+    rolled_up = db.BooleanProperty(default=False)
 
 class UserData(db.Model):
     owner = db.UserProperty(required=True)
     orac_username = db.StringProperty()
 
+class ProblemStats(db.Model):
+    # the counts ProblemHandler shows about a problem, kept up to date as
+    # syncs are applied so the page doesn't have to look at every solution;
+    # they're split over PROBLEM_STATS_SHARDS shards (see
+    # problem_stats_key_name) so syncs of the same problem don't contend,
+    # and shard 0 is only missing for problems that predate the aggregate
+    solved = db.IntegerProperty(default=0)
+    unsolved = db.IntegerProperty(default=0)
+    unattempted = db.IntegerProperty(default=0)
+    # scores[r] is the number of users on r%
+    scores = db.ListProperty(int, indexed=False)
+    # set by hand rather than auto_now, so copies that are written through
+    # to the cache carry it too, and a sum of shards carries the latest
+    updated = db.DateTimeProperty()
+    # how many times the shard has been written, so the sum across shards
+    # changes with every write, however close together, and can be used
+    # in cache keys where updated is too coarse
+    version = db.IntegerProperty(default=0, indexed=False)
+
+    def count(self, result, n):
+        if result == -1:
+            self.unattempted += n
+        else:
+            if result == 100:
+                self.solved += n
+            else:
+                self.unsolved += n
+            self.scores[result] += n
+
+    def add(self, other):
+        self.solved += other.solved
+        self.unsolved += other.unsolved
+        self.unattempted += other.unattempted
+        self.scores = [a + b for a, b in zip(self.scores, other.scores)]
+        self.version += other.version
+        if other.updated and (not self.updated or other.updated > self.updated):
+            self.updated = other.updated
+
+class UserSummary(db.Model):
+    # per-user totals for the leaderboard, keyed like UserData
+    owner = db.UserProperty(required=True)
+    orac_username = db.StringProperty(required=True)
+    solved = db.IntegerProperty(required=True)
+    total_score = db.IntegerProperty(required=True)
+    last_solve = db.DateProperty()
+
+class SyncJob(db.Model):
+    # the state of the user's latest sync with orac, keyed like UserData
+    owner = db.UserProperty(required=True)
+    status = db.StringProperty(required=True, choices=['queued', 'running', 'success', 'failure'])
+    attempts = db.IntegerProperty(default=0)
+    updated = db.DateTimeProperty(auto_now=True)
+
+class StatsFingerprint(db.Model):
+    # hashes of the stats from the user's last sync; a child of their
+    # UserSolutions with key_name 'fingerprint', written in the same
+    # transaction, so it always describes the page the packed solutions
+    # came from
+    orac_username = db.StringProperty(required=True)
+    page_hash = db.StringProperty(required=True, indexed=False)
+    # packed (prob_id, crc32) pairs, one per problem
+    rows = db.BlobProperty(required=True)
+
+class UsernameReservation(db.Model):
+    # keyed by orac username; only its owner can sync as that username
+    owner = db.UserProperty(required=True)
+
+class OracSession(db.Model):
+    # the orac cookie of a user who's asked to be kept up to date, keyed like
+    # UserData
+    owner = db.UserProperty(required=True)
+    cookie = db.StringProperty(required=True, indexed=False)
+
+class ResyncRun(db.Model):
+    # progress and timings of a bulk re-sync of every user
+    started = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+    finished = db.DateTimeProperty()
+    cursor = db.TextProperty()
+    users = db.IntegerProperty(default=0)
+    fetched = db.IntegerProperty(default=0)
+    changed = db.IntegerProperty(default=0)
+    expired = db.IntegerProperty(default=0)
+    failed = db.IntegerProperty(default=0)
+    # seconds spent fetching from orac and applying the results
+    fetch_time = db.FloatProperty(default=0.0)
+    apply_time = db.FloatProperty(default=0.0)
+
 class StatusUpdate(db.Model):
     owner = db.UserProperty(required=True)
     delta = db.ByteStringProperty(required=True)
     timestamp = db.DateTimeProperty(auto_now_add=True)
+    # the delta rendered by render_achievements, filled in when the update
+    # is written; the owner's name is put in front as the feed is read, so
+    # it follows renames
+    achievements = db.TextProperty()
+
+class DailySolves(db.Model):
+    # how many problems were solved on a day across the site, in total and
+    # by problem (packed by pack_counts), kept up to date as syncs are
+    # applied; split over DAILY_SOLVES_SHARDS shards (see
+    # daily_solves_key_name) so syncs on the same day don't contend, so a
+    # day's totals are the sum of every shard with its date, and any one
+    # shard's counts can be negative
+    date = db.DateProperty(required=True)
+    solves = db.IntegerProperty(default=0)
+    counts = db.BlobProperty(default='')
+
+class PendingChanges(db.Model):
+    # what a sync has changed in a user's solutions that's still to be
+    # applied to their Solution entities and the aggregates; it's a child of
+    # their UserSolutions, written in the same transaction, so whatever a
+    # sync fails to apply is picked up by the next, or by the task queued
+    # along with it (see apply_pending)
+    # ids of the problems whose Solution entities need writing
+    solutions = db.ListProperty(int, indexed=False)
+    # packed {prob_id: {result: change in users on it}} for ProblemStats
+    problems = db.BlobProperty(default='')
+    # packed {date: {prob_id: change in solves}} for DailySolves
+    days = db.BlobProperty(default='')
+
+    def empty(self):
+        return not (self.solutions or self.problems or self.days)
 
 def get_user_data(user=None):
     if not user:
         user = users.get_current_user()
-    data = memcache.get('userdata-'+user.user_id())
-    if not data:
-        #data = UserData.all().filter('owner =', user).fetch(1)
+
+    def load():
         key = userdata_key_name(user)
         data = UserData.get_by_key_name(key)
-        if data:
-            memcache.add('userdata-'+user.user_id(), data)
-        else:
+        if not data:
             data = UserData(owner=user, key_name=key)
             data.put()
-            memcache.delete('users')
-    return data
-
-def set_orac_username(username):
-    data = get_user_data()
+        return data
+    return memo.get('UserData', user.user_id(), lambda: cache.get('userdata-'+user.user_id(), load))
+
+def get_user_data_multi(owners):
+    # like get_user_data, but for many users at once; returns a list in the
+    # same order as owners, with None for anyone who has no data
+    def load(missing):
+        fetched = dict()
+        for data in UserData.get_by_key_name([key[len('userdata-'):] for key in missing]):
+            if data:
+                fetched['userdata-'+data.owner.user_id()] = data
+        return fetched
+
+    def fetch(user_ids):
+        cached = cache.get_multi(['userdata-'+user_id for user_id in user_ids], load)
+        return dict([(user_id, cached.get('userdata-'+user_id)) for user_id in user_ids])
+    return memo.get_multi('UserData', [owner.user_id() for owner in owners], fetch)
+
+def set_orac_username(username, user=None):
+    data = get_user_data(user)
     if data.orac_username != username:
+        old_username = data.orac_username
         data.orac_username = username
         data.put()
-        memcache.delete('userdata-'+data.owner.user_id())
-        memcache.delete('users')
+        cache.set('userdata-'+data.owner.user_id(), data)
+        memo.set('UserData', data.owner.user_id(), data)
+        cache.bump('users')
+        if old_username:
+            release_username(old_username, data.owner)
+
+def reserve_username(username, user):
+    # claims username for user, returning False if someone else holds it;
+    # usernames taken before they were reserved are reserved by
+    # ReserveUsernamesHandler
+    def txn():
+        reservation = UsernameReservation.get_by_key_name(username)
+        if reservation:
+            return reservation.owner.user_id() == user.user_id()
+        UsernameReservation(key_name=username, owner=user).put()
+        return True
+    return db.run_in_transaction(txn)
+
+def release_username(username, user):
+    def txn():
+        reservation = UsernameReservation.get_by_key_name(username)
+        if reservation and reservation.owner.user_id() == user.user_id():
+            reservation.delete()
+    db.run_in_transaction(txn)
 
 def problem_key_name(prob_id):
     return str(prob_id)
@@ -118,35 +347,260 @@ def solution_key_name(prob_id, owner):
 def userdata_key_name(owner):
     return owner.user_id()
 
-def get_problem(prob_id):
-    key = 'problem-' + str(prob_id)
-    problem = memcache.get(key)
-    if not problem:
-        problem = Problem.get_by_key_name(problem_key_name(prob_id))
-        if problem:
-            memcache.add(key, problem)
-    return problem
+def solution_result(result, solve_date):
+    # -1 if the problem hasn't been attempted
+    if not solve_date and result == 0:
+        return -1
+    return result
+
+# a problem's ProblemStats is split over this many shards
+PROBLEM_STATS_SHARDS = 8
+
+def problem_stats_key_name(prob_id, shard=0):
+    # shard 0 is keyed like the problem, as the unsharded aggregate was
+    if shard == 0:
+        return problem_key_name(prob_id)
+    return '%s-%d' % (prob_id, shard)
+
+def user_shard(user, shards):
+    # each user's changes go to the same one of an aggregate's shards
+    return int(hashlib.md5(user.user_id()).hexdigest(), 16) % shards
+
+def new_problem_stats(prob_id, shard=0):
+    return ProblemStats(key_name=problem_stats_key_name(prob_id, shard), scores=[0]*101)
+
+def load_problem_stats(prob_id):
+    # returns the problem's shards summed, or None if it has no aggregate yet
+    shards = ProblemStats.get_by_key_name([problem_stats_key_name(prob_id, shard) for shard in xrange(PROBLEM_STATS_SHARDS)])
+    if not shards[0]:
+        return None
+    stats = new_problem_stats(prob_id)
+    for shard in shards:
+        if shard:
+            stats.add(shard)
+    return stats
+
+def get_problem_stats(prob_id):
+    # a problem that predates the aggregate counts as unattempted by everyone
+    # until BuildProblemStatsHandler has built it
+    def load():
+        return load_problem_stats(prob_id) or new_problem_stats(prob_id)
+    return memo.get('ProblemStats', str(prob_id), lambda: cache.get('problemstats-' + str(prob_id), load))
+
+def forget_problem_stats(prob_ids):
+    cache.delete_multi(['problemstats-' + str(prob_id) for prob_id in prob_ids])
+    for prob_id in prob_ids:
+        memo.forget('ProblemStats', str(prob_id))
+
+def build_problem_stats(prob_id):
+    # builds the aggregate from scratch, for problems that predate it; it
+    # all goes in shard 0, and changes are only applied once that exists
+    stats = new_problem_stats(prob_id)
+    for soln in Solution.all().filter('prob_id =', int(prob_id)).run():
+        stats.count(solution_result(soln.result, soln.solve_date), 1)
+    stats.updated = datetime.datetime.now()
+    stats.version = 1
+
+    def txn():
+        stored = ProblemStats.get_by_key_name(stats.key().name())
+        if stored:
+            return False
+        stats.put()
+        return True
+    if not db.run_in_transaction(txn):
+        return load_problem_stats(prob_id)
+    return stats
+
+XG_LIMIT = 25
+
+def insert_problems(problems):
+    # puts each of the problems that isn't already stored, along with shard
+    # 0 of its ProblemStats, in cross-group transactions of up to XG_LIMIT
+    # groups each, so concurrent syncs don't write over each other; a
+    # problem without shard 0 is then one that predates the aggregate
+    def txn(batch):
+        existing = db.get([problem.key() for problem in batch])
+        to_put = list()
+        for problem, stored in zip(batch, existing):
+            if not stored:
+                to_put.extend([problem, new_problem_stats(problem.prob_id)])
+        if to_put:
+            db.put(to_put)
+
+    options = db.create_transaction_options(xg=True)
+    for i in xrange(0, len(problems), XG_LIMIT/2):
+        db.run_in_transaction_options(options, txn, problems[i:i+XG_LIMIT/2])
+
+def make_user_summary(user, username, results):
+    # results is a (result, solve_date) pair for every problem the user has
+    solved = 0
+    total_score = 0
+    last_solve = None
+    for result, solve_date in results:
+        if result == 100:
+            solved += 1
+        total_score += result
+        if solve_date and (not last_solve or solve_date > last_solve):
+            last_solve = solve_date
+    return UserSummary(key_name=userdata_key_name(user), owner=user, orac_username=username,
+                       solved=solved, total_score=total_score, last_solve=last_solve)
+
+def same_summary(a, b):
+    return a and b and (a.orac_username, a.solved, a.total_score, a.last_solve) == (b.orac_username, b.solved, b.total_score, b.last_solve)
+
+def forget_summaries():
+    cache.delete('leaderboard')
+    cache.bump('ranks')
+
+def update_user_summary(user, username, results):
+    summary = make_user_summary(user, username, results)
+
+    def txn():
+        if same_summary(UserSummary.get_by_key_name(summary.key().name()), summary):
+            return False
+        summary.put()
+        return True
+
+    if db.run_in_transaction(txn):
+        forget_summaries()
+
+LEADERBOARD_SIZE = 50
+# ranks are counted only this far; anyone further down is shown as being
+# ranked below it, since counting costs a read per user ahead
+RANK_LIMIT = 1000
+
+def get_leaderboard():
+    def load():
+        return UserSummary.all().order('-solved').order('-total_score').fetch(LEADERBOARD_SIZE)
+    return cache.get('leaderboard', load, local_ttl=cache.LOCAL_TTL)
+
+def get_rank(summary):
+    # one more than the number of users ahead in the leaderboard's order,
+    # that is with more problems solved, or as many and a higher total
+    # score, and whether that's exact; past RANK_LIMIT it's RANK_LIMIT+1
+    # and not exact
+    def load():
+        ahead = UserSummary.all(keys_only=True).filter('solved >', summary.solved).count(RANK_LIMIT)
+        if ahead < RANK_LIMIT:
+            ahead += UserSummary.all(keys_only=True).filter('solved =', summary.solved) \
+                .filter('total_score >', summary.total_score).count(RANK_LIMIT - ahead)
+        return min(ahead, RANK_LIMIT) + 1, ahead < RANK_LIMIT
+    # everyone with the same totals has the same rank
+    return cache.get('rank-%d-%d' % (summary.solved, summary.total_score), load, namespace='ranks')
+
+def rank_leaderboard(leaderboard):
+    # numbers the leaderboard like get_rank, so users with the same totals
+    # share a rank
+    ranked = list()
+    for i, summary in enumerate(leaderboard):
+        if ranked and (summary.solved, summary.total_score) == (ranked[-1][1].solved, ranked[-1][1].total_score):
+            ranked.append((ranked[-1][0], summary))
+        else:
+            ranked.append((i+1, summary))
+    return ranked
 
+def count_solves(solves, changes, step=1):
+    # adds step to changes[solve_date][prob_id] for each (prob_id, result,
+    # solve_date) that's a solve
+    for prob_id, result, solve_date in solves:
+        if result == 100 and solve_date:
+            day = changes.setdefault(solve_date, dict())
+            day[prob_id] = day.get(prob_id, 0) + step
+
+def get_problem(prob_id):
+    return get_problems([prob_id])[0]
+
+def get_problems(prob_ids):
+    # returns the Problem for each id, or None if there isn't one
+    def load(missing):
+        fetched = dict()
+        for problem in Problem.get_by_key_name([problem_key_name(key[len('problem-'):]) for key in missing]):
+            if problem:
+                fetched['problem-' + str(problem.prob_id)] = problem
+        return fetched
+
+    def fetch(ids):
+        cached = cache.get_multi(['problem-' + prob_id for prob_id in ids], load)
+        return dict([(prob_id, cached.get('problem-' + prob_id)) for prob_id in ids])
+    return memo.get_multi('Problem', [str(prob_id) for prob_id in prob_ids], fetch)
+
+# everything cached about a user's solutions lives in their namespace, so
+# it can all be dropped at once when they sync
+def user_namespace(user):
+    return 'user-' + user.user_id()
+
+def load_user_solutions(owners):
+    # returns the packed solutions for each of the given users; anyone who
+    # hasn't synced since solutions were packed, and whom
+    # PackSolutionsHandler hasn't got to yet, has theirs packed from a
+    # query on their Solution entities, which isn't stored
+    entities = UserSolutions.get_by_key_name([userdata_key_name(owner) for owner in owners])
+    # run() starts each query straight away rather than when it's read
+    queries = dict([(i, Solution.all().filter('owner =', owners[i]).run(batch_size=1000))
+                    for i, entity in enumerate(entities) if not entity])
+    packed = list()
+    for i, entity in enumerate(entities):
+        if entity:
+            packed.append(entity.packed)
+        else:
+            packed.append(pack_solutions([(soln.prob_id, soln.result, soln.solve_date) for soln in queries[i]]))
+    return packed
+
+# keys per batch get when packing a user's Solution entities
+PACK_BATCH_SIZE = 1000
+
+def pack_legacy_solutions(owner, prob_ids):
+    # packs the owner's Solution entities for the given problems, reading
+    # them by key so it's consistent with the writes that made them
+    keys = [db.Key.from_path('Solution', solution_key_name(prob_id, owner)) for prob_id in prob_ids]
+    solns = list()
+    for i in xrange(0, len(keys), PACK_BATCH_SIZE):
+        solns.extend([soln for soln in db.get(keys[i:i+PACK_BATCH_SIZE]) if soln])
+    return pack_solutions([(soln.prob_id, soln.result, soln.solve_date) for soln in solns])
+
+# a user's solutions are cached packed, and only unpacked into SolutionRows
+# for the request that needs them
 def get_solutions_for_user(user):
-    key = 'solutions-for-user-' + user.user_id()
-    data = memcache.get(key)
-    if not data:
-        data = Solution.all().filter('owner =', user).run()
-        data = list(data)
-        memcache.add(key, data)
-    return data
+    def load():
+        return load_user_solutions([user])[0]
+    return memo.get('Solution', user.user_id(),
+        lambda: unpack_solutions(cache.get('solutions-for-user-' + user.user_id(), load, namespace=user_namespace(user))))
+
+def get_solutions_for_users(owners):
+    # like get_solutions_for_user, but for many users at once
+    keys = cache.versioned_multi(['solutions-for-user-' + owner.user_id() for owner in owners], [user_namespace(owner) for owner in owners])
+    owners_by_key = dict(zip(keys, owners))
+
+    def load(missing):
+        packed = load_user_solutions([owners_by_key[key] for key in missing])
+        return dict(zip(missing, packed))
+
+    def fetch(user_ids):
+        wanted = [key for key in keys if owners_by_key[key].user_id() in user_ids]
+        cached = cache.get_multi(wanted, load)
+        return dict([(owners_by_key[key].user_id(), unpack_solutions(cached[key])) for key in wanted])
+    return memo.get_multi('Solution', [owner.user_id() for owner in owners], fetch)
+
+def get_score_vectors(owners):
+    # returns a ScoreVector for each of the given users
+    keys = cache.versioned_multi(['scores-' + owner.user_id() for owner in owners], [user_namespace(owner) for owner in owners])
+    owners_by_key = dict(zip(keys, owners))
+
+    def load(missing):
+        built = dict()
+        all_solns = get_solutions_for_users([owners_by_key[key] for key in missing])
+        for key, solns in zip(missing, all_solns):
+            built[key] = ScoreVector([(soln.prob_id, solution_result(soln.result, soln.solve_date)) for soln in solns])
+        return built
+    cached = cache.get_multi(keys, load)
+    return [cached[key] for key in keys]
 
 def get_problems_for_user(user):
-    key = 'problems-for-user-' + user.user_id()
-    probs = memcache.get(key)
-    if not probs:
+    def load():
         solns = get_solutions_for_user(user)
-        probs = list()
-        for soln in solns:
-            probs.append(get_problem(soln.prob_id))
-        probs = sorted(probs, key=lambda a: a.name)
-        memcache.add(key, probs)
-    return probs
+        probs = [prob for prob in get_problems([soln.prob_id for soln in solns]) if prob]
+        return sorted(probs, key=lambda a: a.name)
+    return cache.get('problems-for-user-' + user.user_id(), load, namespace=user_namespace(user))
 
 def login_check(self):
     if not users.get_current_user():
@@ -165,6 +619,76 @@ def has_problems_check(self):
         return False
     return True
 
+# number of updates shown per page of the feed, and the most that can be asked for
+FEED_LENGTH = 5
+FEED_MAX_LENGTH = 50
+DELTA_VERSION = 1
+
+def encode_delta(delta, cut):
+    # deltas are stored as {"v": version, "e": [[name, old_result, new_result], ...], "c": cut}
+    return json.dumps({'v': DELTA_VERSION, 'e': delta, 'c': cut}, separators=(',', ':'))
+
+def decode_delta(delta_bytes):
+    # returns the delta's (name, old_result, new_result) tuples along with
+    # the number of entries that were cut off the end
+    if delta_bytes.startswith('{'):
+        data = json.loads(delta_bytes)
+        return [tuple(entry) for entry in data['e']], data['c']
+
+    # older updates are a pickled list, with a (None, 0, cut) trailer if
+    # anything was cut
+    delta = pickle.loads(delta_bytes)
+    last, _, cut = delta[-1]
+    if last is None:
+        delta = delta[:-1]
+    else:
+        cut = 0
+    return delta, cut
+
+def render_achievements(delta):
+    # the delta as a sentence, without its subject
+    solved = list()
+    boost = list()
+    for name, old, new in delta:
+        if new == 100:
+            solved.append(name)
+        else:
+            boost.append('%d%% in %s' % (new, name))
+
+    achievements = list()
+    if len(solved):
+        achievements.append('solved ' + (solved[0] if len(solved) == 1 else ', '.join(solved[:-1]) + ' and ' + solved[-1]))
+    if len(boost):
+        achievements.append('achieved a new personal best of ' + (boost[0] if len(boost) == 1 else ', '.join(boost[:-1]) + ' and ' + boost[-1]))
+
+    return achievements[0] if len(achievements) == 1 else achievements[0] + ' and ' + achievements[1]
+
+def render_update(username, achievements):
+    return '%s %s.' % (username, achievements)
+
+def render_timestamp(timestamp):
+    return datetime.datetime.strftime(timestamp + datetime.timedelta(hours=11), "%I:%M%p %A %d %B %Y")
+
+def get_feed(cursor, limit):
+    # returns a page of the feed, newest first, as (timestamp, username,
+    # achievements), and the cursor for the next page if there is one;
+    # names are looked up as the page is read, and updates from anyone
+    # without one are left out
+    def load():
+        updates, next_cursor = fetch_page(StatusUpdate.all().order('-timestamp'), cursor, limit)
+        # updates written before achievements were stored are rendered
+        # from their deltas
+        return [(update.timestamp, update.owner,
+                 update.achievements if update.achievements is not None else render_achievements(decode_delta(update.delta)[0]))
+                for update in updates], next_cursor
+    entries, next_cursor = cache.get('feed-%s-%d' % (cursor_key(cursor), limit), load, namespace='feed', local_ttl=cache.LOCAL_TTL)
+
+    feed = list()
+    for (timestamp, owner, achievements), data in zip(entries, get_user_data_multi([owner for _, owner, _ in entries])):
+        if data and data.orac_username:
+            feed.append((timestamp, data.orac_username, achievements))
+    return feed, next_cursor
+
 class HomeHandler(webapp.RequestHandler):
     def get(self):
         template_values = standard_template_values()
@@ -172,45 +696,378 @@ class HomeHandler(webapp.RequestHandler):
         template_values['error'] = self.request.get('error')
 
         # get status updates
-        update_objects = memcache.get('updates')
-        if not update_objects:
-            update_objects = list(StatusUpdate.all().order('-timestamp').run(limit=5))
-            memcache.add('updates', update_objects)
-        # decode deltas into proper strings
-        updates = list()
-        for update_object in update_objects:
-            delta = pickle.loads(update_object.delta)
-            last, _, cut = delta[-1]
-            if last is None:
-                delta = delta[:-1]
-            else:
-                cut = 0
-
-            username = get_user_data(update_object.owner).orac_username
-
-            solved = list()
-            boost = list()
-            for name, old, new in delta:
-                if new == 100:
-                    solved.append(name)
-                else:
-                    boost.append('%d%% in %s' % (new, name))
-
-            achievements = list()
-            if len(solved):
-                achievements.append('solved ' + (solved[0] if len(solved) == 1 else ', '.join(solved[:-1]) + ' and ' + solved[-1]))
-            if len(boost):
-                achievements.append('achieved a new personal best of ' + (boost[0] if len(boost) == 1 else ', '.join(boost[:-1]) + ' and ' + boost[-1]))
-
-            string = username + ' '
-            string += achievements[0] if len(achievements) == 1 else achievements[0] + ' and ' + achievements[1]
-            string += '.'
-            dt = datetime.datetime.strftime(update_object.timestamp + datetime.timedelta(hours=11), "%I:%M%p %A %d %B %Y")
-            updates.append((dt, string))
+        cursor = self.request.get('c')
+        try:
+            length = min(max(int(self.request.get('n', FEED_LENGTH)), 1), FEED_MAX_LENGTH)
+        except ValueError:
+            length = FEED_LENGTH
+
+        updates, next_cursor = get_feed(cursor, length)
+        suffix = '&n=%d' % length if length != FEED_LENGTH else ''
+        if next_cursor:
+            template_values['older_url'] = '/?c=%s%s' % (next_cursor, suffix)
+        if cursor:
+            template_values['newest_url'] = '/?n=%d' % length if suffix else '/'
+        updates = [(render_timestamp(timestamp), render_update(username, achievements)) for timestamp, username, achievements in updates]
 
         template_values['updates'] = [updates[i]+(i==0,i==len(updates)-1) for i in xrange(len(updates))] if len(updates) else None
 
-        self.response.out.write(template.render(HTML_PATH, template_values))
+        write_page(self, template_values)
+
+# the task queued with each sync runs this long after it, by when the sync
+# has normally applied its changes itself
+PENDING_DELAY = 60
+
+def fingerprint_key(user):
+    return db.Key.from_path('UserSolutions', userdata_key_name(user), 'StatsFingerprint', 'fingerprint')
+
+def pending_key(user):
+    return db.Key.from_path('UserSolutions', userdata_key_name(user), 'PendingChanges', 'pending')
+
+def add_pending(pending, solutions, problems, days):
+    # merges a sync's changes into what's already pending
+    pending.solutions = sorted(set(pending.solutions) | set(solutions))
+    pending.problems = pack_nested_counts(merge_changes(unpack_nested_counts(pending.problems), problems))
+    pending.days = pack_day_counts(merge_changes(unpack_day_counts(pending.days), days))
+
+def merge_changes(merged, changes):
+    # adds {key: {k: change}} changes into merged, dropping whatever comes
+    # to nothing
+    for key, counts in changes.iteritems():
+        inner = merged.setdefault(key, dict())
+        for k, change in counts.iteritems():
+            inner[k] = inner.get(k, 0) + change
+    return dict([(key, dict([(k, change) for k, change in counts.iteritems() if change]))
+                 for key, counts in merged.iteritems() if any(counts.values())])
+
+def save_pending(pending, entities):
+    # puts entities along with whatever's left of pending, in a transaction;
+    # returns pending, or None if there was nothing left of it
+    if pending.empty():
+        db.delete(pending)
+        pending = None
+    else:
+        entities = entities + [pending]
+    db.put(entities)
+    return pending
+
+def make_solution(user, username, soln):
+    # the Solution entity for one of the user's SolutionRows
+    return Solution(prob_id=soln.prob_id, owner=user, result=soln.result, solve_date=soln.solve_date, username=username,
+                    listed_result=solution_result(soln.result, soln.solve_date), key_name=solution_key_name(soln.prob_id, user))
+
+def write_pending_solutions(user, pending):
+    # writes the Solution entities for the problems in pending.solutions
+    # from the user's packed solutions, then takes them out of pending, as
+    # long as the packed solutions haven't changed since; if they have, the
+    # next time round writes them again
+    user_solns = UserSolutions.get_by_key_name(userdata_key_name(user))
+    solns = dict([(soln.prob_id, soln) for soln in unpack_solutions(user_solns.packed)])
+    username = get_user_data(user).orac_username
+    db.put([make_solution(user, username, solns[prob_id]) for prob_id in pending.solutions if prob_id in solns])
+
+    def txn():
+        current, pending = db.get([user_solns.key(), pending_key(user)])
+        if pending and current.packed == user_solns.packed:
+            pending.solutions = [prob_id for prob_id in pending.solutions if prob_id not in solns]
+            pending = save_pending(pending, [])
+        return pending
+    pending = db.run_in_transaction(txn)
+    cache.bump(user_namespace(user))
+    memo.forget('Solution', user.user_id())
+    return pending
+
+def apply_pending_problems(user, prob_ids, built):
+    # moves the changes for prob_ids from the user's PendingChanges into
+    # their shard of each ProblemStats, in one cross-group transaction;
+    # built is the problems whose shard 0 exists
+    pending = db.get(pending_key(user))
+    if not pending:
+        return None
+    changes = unpack_nested_counts(pending.problems)
+    prob_ids = [prob_id for prob_id in prob_ids if prob_id in changes]
+    shard = user_shard(user, PROBLEM_STATS_SHARDS)
+    to_put = list()
+    for prob_id, stats in zip(prob_ids, ProblemStats.get_by_key_name([problem_stats_key_name(prob_id, shard) for prob_id in prob_ids])):
+        counts = changes.pop(prob_id)
+        if prob_id not in built:
+            # leave it for BuildProblemStatsHandler to build
+            continue
+        if not stats:
+            stats = new_problem_stats(prob_id, shard)
+        for result, change in counts.iteritems():
+            stats.count(result, change)
+        stats.updated = datetime.datetime.now()
+        stats.version += 1
+        to_put.append(stats)
+    pending.problems = pack_nested_counts(changes)
+    return save_pending(pending, to_put)
+
+# each day's DailySolves is split over this many shards
+DAILY_SOLVES_SHARDS = 8
+
+def daily_solves_key_name(date, shard=0):
+    # shard 0 is keyed by the date alone, as the unsharded rollup was
+    if shard == 0:
+        return date.isoformat()
+    return '%s/%d' % (date.isoformat(), shard)
+
+def apply_pending_days(user, dates):
+    # moves the solves for dates from the user's PendingChanges into their
+    # shard of each day's DailySolves, in one cross-group transaction
+    pending = db.get(pending_key(user))
+    if not pending:
+        return None
+    days = unpack_day_counts(pending.days)
+    dates = [date for date in dates if date in days]
+    shard = user_shard(user, DAILY_SOLVES_SHARDS)
+    to_put = list()
+    for date, bucket in zip(dates, DailySolves.get_by_key_name([daily_solves_key_name(date, shard) for date in dates])):
+        if not bucket:
+            bucket = DailySolves(key_name=daily_solves_key_name(date, shard), date=date)
+        counts = unpack_counts(bucket.counts)
+        for prob_id, change in days.pop(date).iteritems():
+            counts[prob_id] = counts.get(prob_id, 0) + change
+            bucket.solves += change
+        bucket.counts = pack_counts(dict([(prob_id, count) for prob_id, count in counts.iteritems() if count]))
+        to_put.append(bucket)
+    pending.days = pack_day_counts(days)
+    return save_pending(pending, to_put)
+
+def apply_pending(user):
+    # applies everything in the user's PendingChanges, a transaction at a
+    # time; each transaction takes what it applies out of the
+    # PendingChanges, so nothing is applied twice, however many times this
+    # runs or however many run at once
+    options = db.create_transaction_options(xg=True)
+    # each step hands back what's left; anything a sync adds in the
+    # meantime is applied by that sync
+    pending = db.get(pending_key(user))
+    while pending:
+        if pending.solutions:
+            pending = write_pending_solutions(user, pending)
+        elif pending.problems:
+            # one group is the PendingChanges
+            prob_ids = sorted(unpack_nested_counts(pending.problems))[:XG_LIMIT-1]
+            # a shard 0 never goes away once it's there, so this needn't be
+            # in the transaction
+            built = set([prob_id for prob_id, stats in zip(prob_ids, ProblemStats.get_by_key_name([problem_key_name(prob_id) for prob_id in prob_ids])) if stats])
+            pending = db.run_in_transaction_options(options, apply_pending_problems, user, prob_ids, built)
+            forget_problem_stats(prob_ids)
+        elif pending.days:
+            dates = sorted(unpack_day_counts(pending.days))[:XG_LIMIT-1]
+            pending = db.run_in_transaction_options(options, apply_pending_days, user, dates)
+            cache.bump('rollups')
+        else:
+            pending = db.run_in_transaction(save_pending, pending, [])
+
+def make_status_update(user, delta):
+    # sort the delta by the new score
+    # it contains tuples in the format (name, old_result, new_result)
+    delta = sorted(delta, key=lambda a:a[2], reverse=True)
+    # limit the delta to 5 problems
+    total = len(delta)
+    limit = 5
+    cut = max(total - limit, 0)
+    delta = delta[:limit]
+
+    delta_bytes = encode_delta(delta, cut)
+    return StatusUpdate(delta=delta_bytes, owner=user, achievements=render_achievements(delta))
+
+def apply_stats(user, username, stats):
+    # stores everything get_probs_stats found for the user; returns False if
+    # nothing has changed since the last sync
+    page_hash, rows = fingerprint_stats(stats)
+    # the fingerprint is written with the packed solutions, so a sync that
+    # died after that may still have changes pending
+    fingerprint, pending = db.get([fingerprint_key(user), pending_key(user)])
+    if fingerprint and fingerprint.orac_username == username:
+        if fingerprint.page_hash == page_hash:
+            if pending:
+                apply_pending(user)
+            return False
+        # only look at the problems whose rows have changed
+        old_rows = unpack_fingerprints(fingerprint.rows)
+        prob_ids = [prob_id for prob_id, row in rows.iteritems() if old_rows.get(prob_id) != row]
+    else:
+        prob_ids = stats.keys()
+    seen = fingerprint and (fingerprint.orac_username, fingerprint.page_hash)
+
+    # fetch every problem this upload touches and all the user's solutions
+    # in one go, while the username is being stored
+    problems = db.get_async([db.Key.from_path('Problem', problem_key_name(prob_id)) for prob_id in prob_ids])
+    user_solns = db.get_async(db.Key.from_path('UserSolutions', userdata_key_name(user)))
+
+    old_username = get_user_data(user).orac_username
+    uploaded_before = old_username is not None
+    renamed = uploaded_before and old_username != username
+    set_orac_username(username, user)
+
+    problems = problems.get_result()
+    # someone who hasn't synced since solutions were packed gets theirs
+    # packed now, from everything orac says they've got
+    legacy = None
+    if not user_solns.get_result():
+        legacy = pack_legacy_solutions(user, stats.keys())
+
+    # create the problems that don't exist; someone else syncing might be
+    # creating them too
+    new_probs = set([prob_id for prob_id, problem in zip(prob_ids, problems) if not problem])
+    insert_problems([Problem(prob_id=prob_id, name=stats[prob_id][0], key_name=problem_key_name(prob_id)) for prob_id in new_probs])
+
+    def txn():
+        # the user's solutions are replaced as a whole, so concurrent syncs
+        # can't interleave; what needs to follow from the change is recorded
+        # in their PendingChanges, along with the status update, all or
+        # nothing
+        user_solns, fingerprint, pending, summary = db.get([db.Key.from_path('UserSolutions', userdata_key_name(user)),
+            fingerprint_key(user), pending_key(user), db.Key.from_path('UserSummary', userdata_key_name(user))])
+        if fingerprint and (fingerprint.orac_username, fingerprint.page_hash) == (username, page_hash):
+            # another sync of the same page got here first
+            return None, False
+        created = not user_solns
+        if created:
+            # someone with nothing to count is already rolled up
+            user_solns = UserSolutions(key_name=userdata_key_name(user), owner=user, packed=legacy or '', rolled_up=not legacy)
+        solns = dict([(soln.prob_id, soln) for soln in unpack_solutions(user_solns.packed)])
+        # if another sync has been since the fingerprint was read, the rows
+        # it picked out may be out of date, so every row is looked at
+        changed_ids = prob_ids if (fingerprint and (fingerprint.orac_username, fingerprint.page_hash)) == seen else stats.keys()
+        to_put = [StatsFingerprint(key_name='fingerprint', parent=user_solns, orac_username=username,
+                                   page_hash=page_hash, rows=pack_fingerprints(rows))]
+        new_summary = make_user_summary(user, username, [(result, solve_date) for name, result, solve_date in stats.values()])
+        summarised = not same_summary(summary, new_summary)
+        if summarised:
+            to_put.append(new_summary)
+        delta = list()
+        changed = list()
+        # unchanged solutions that need writing again under the new username
+        rewritten = list()
+        # {prob_id: {result: change in users on it}} for ProblemStats
+        results = dict()
+        # {date: {prob_id: change in solves}} for DailySolves
+        solve_changes = dict()
+
+        for prob_id in changed_ids:
+            name, result, solve_date = stats[prob_id]
+            soln = solns.get(prob_id)
+            if soln:
+                if soln.result == result:
+                    if renamed:
+                        rewritten.append(prob_id)
+                    continue
+                old_result = -1 if not soln.solve_date else soln.result
+                delta.append((name, old_result, result))
+                if user_solns.rolled_up:
+                    count_solves([soln], solve_changes, -1)
+                counts = results.setdefault(prob_id, dict())
+                listed = solution_result(soln.result, soln.solve_date)
+                counts[listed] = counts.get(listed, 0) - 1
+            solns[prob_id] = SolutionRow(prob_id, result, solve_date)
+            if user_solns.rolled_up:
+                count_solves([solns[prob_id]], solve_changes)
+            changed.append(prob_id)
+            counts = results.setdefault(prob_id, dict())
+            listed = solution_result(result, solve_date)
+            counts[listed] = counts.get(listed, 0) + 1
+
+        if created:
+            to_put.append(user_solns)
+        if not (changed or rewritten):
+            db.put(to_put)
+            return False, summarised
+        pending = pending or PendingChanges(key_name='pending', parent=user_solns)
+        add_pending(pending, changed + rewritten, results, solve_changes)
+        to_put.append(pending)
+        if changed:
+            user_solns.packed = pack_solutions(solns.values())
+            if not created:
+                to_put.append(user_solns)
+        update = None
+        if len(delta) > 0 and uploaded_before:
+            update = make_status_update(user, delta)
+            to_put.append(update)
+        db.put(to_put)
+        # in case this sync dies before it's applied everything
+        taskqueue.add(url='/_tasks/apply-pending', params={'user_id': user.user_id()}, countdown=PENDING_DELAY, transactional=True)
+        return update is not None, summarised
+    updated, summarised = db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+    if updated is None:
+        apply_pending(user)
+        return False
+
+    if updated:
+        cache.bump('feed')
+    if summarised:
+        forget_summaries()
+    if legacy is not None:
+        cache.bump(user_namespace(user))
+        memo.forget('Solution', user.user_id())
+    # this also finishes off anything an earlier sync left undone
+    apply_pending(user)
+    return True
+
+# a sync that's been queued or running this long is assumed to be lost
+SYNC_TIMEOUT = datetime.timedelta(minutes=10)
+# the task queue gives up on a sync after this many retries (see queue.yaml)
+SYNC_RETRY_LIMIT = 5
+
+# at most this many hub pages a second are fetched from orac, by syncs and
+# re-syncs on every instance together
+ORAC_RATE = 4
+orac_limiter = SharedRateLimiter('orac-rate', ORAC_RATE)
+
+runner = jobs.TaskQueueRunner('sync')
+
+def set_sync_status(user_id, status, attempts=None):
+    job = SyncJob.get_by_key_name(user_id)
+    job.status = status
+    if attempts is not None:
+        job.attempts = attempts
+    job.put()
+    return job
+
+def queue_sync(user, username, cookie):
+    # returns False if there's already a sync on the way for this user
+    def txn():
+        job = SyncJob.get_by_key_name(userdata_key_name(user))
+        if job and job.status in ('queued', 'running') and job.updated > datetime.datetime.now() - SYNC_TIMEOUT:
+            return False
+        SyncJob(key_name=userdata_key_name(user), owner=user, status='queued').put()
+        return True
+
+    if not db.run_in_transaction(txn):
+        return False
+    runner.enqueue('/_tasks/sync', {'user_id': userdata_key_name(user), 'username': username, 'cookie': cookie})
+    return True
+
+def run_sync(user_id, username, cookie, attempt=0):
+    job = set_sync_status(user_id, 'running', attempt+1)
+    try:
+        orac_limiter.wait()
+        data = fetch_hub(cookie)
+        if not data:
+            # orac didn't like the cookie, so trying again won't help
+            set_sync_status(user_id, 'failure')
+            return
+        # the hub is read as it's parsed, so this includes the time spent
+        # waiting on orac for the page body
+        try:
+            with timed('parse'):
+                stats = get_probs_stats(data)
+        finally:
+            data.close()
+        apply_stats(job.owner, username, stats)
+    except Exception:
+        if attempt >= SYNC_RETRY_LIMIT:
+            logging.exception('Giving up on sync for %s', username)
+            set_sync_status(user_id, 'failure')
+            return
+        set_sync_status(user_id, 'queued')
+        raise
+    set_sync_status(user_id, 'success')
+
+runner.register('/_tasks/sync', run_sync)
 
 class UpdateHandler(webapp.RequestHandler):
     def get(self):
@@ -220,8 +1077,10 @@ class UpdateHandler(webapp.RequestHandler):
         template_values = standard_template_values()
         template_values['page'] = UPDATE
         template_values['status'] = self.request.get('status')
-        data = get_user_data()
-        self.response.out.write(template.render(HTML_PATH, template_values))
+        key = userdata_key_name(users.get_current_user())
+        template_values['sync'], session = db.get([db.Key.from_path('SyncJob', key), db.Key.from_path('OracSession', key)])
+        template_values['keep'] = session is not None
+        write_page(self, template_values)
 
     def post(self):
         if not login_check(self):
@@ -235,81 +1094,68 @@ class UpdateHandler(webapp.RequestHandler):
             self.response.headers.add_header('Location', '?status=badchars')
             return
 
-        # make sure no-one is using this username already
         user = users.get_current_user()
 
-        result = UserData.all().filter('orac_username =', username).fetch(1)
-        if len(result):
-            if result[0].owner.user_id() != user.user_id():
-                self.response.set_status(303)
-                self.response.headers.add_header('Location', '?status=badusername')
-                return
-
-        data = fetch_stats(username, password)
-        if not data:
+        # log in now so bad passwords are caught straight away; the hub is
+        # fetched in the background
+        cookie = orac_login(username, password)
+        if not cookie:
             self.response.set_status(303)
             self.response.headers.add_header('Location', '?status=failure')
             return
 
-        uploaded_before = get_user_data().orac_username is not None
-        set_orac_username(username)
-
-        stats = get_probs_stats(data)
-
-        problems_changed = False
-        memcache.delete('solutions-for-user-' + user.user_id())
-        memcache.delete('problems-for-user-' + user.user_id())
+        # only claim the username once we know it's theirs, in case someone
+        # else got there first in the meantime
+        if not reserve_username(username, user):
+            self.response.set_status(303)
+            self.response.headers.add_header('Location', '?status=badusername')
+            return
 
-        delta = list()
+        key = userdata_key_name(user)
+        if self.request.get('keep'):
+            OracSession(key_name=key, owner=user, cookie=cookie).put()
+        else:
+            db.delete(db.Key.from_path('OracSession', key))
 
-        for prob_id, value in stats.items():
-            name, result, solve_date = value
-            # check whether this problem exists
-            # create it if it doesn't
-            key = problem_key_name(prob_id)
-            if not Problem.get_by_key_name(key):
-                prob = Problem(prob_id=prob_id, name=name, key_name=key)
-                prob.put()
-
-            # check whether a solution already exists
-            soln_changed = False
-            key = solution_key_name(prob_id, user)
-            soln = Solution.get_by_key_name(key)
-            if soln:
-                if soln.result != result:
-                    old_result = -1 if not soln.solve_date else soln.result
-                    delta.append((name, old_result, result))
-                    soln.result = result
-                    soln.solve_date = solve_date
-                    soln.put()
-                    soln_changed = True
-            else:
-                q = Solution(prob_id=prob_id, owner=user, result=result, solve_date=solve_date, key_name=key)
-                q.put()
-                soln_changed = True
+        if queue_sync(user, username, cookie):
+            status = 'queued'
+        else:
+            status = 'pending'
 
-            if soln_changed:
-                memcache.delete('solutions-%d' % prob_id)
+        self.response.set_status(303)
+        self.response.headers.add_header('Location', '?status=' + status)
 
-        if len(delta) > 0 and uploaded_before:
-            # sort the delta by the new score
-            # it contains tuples in the format (name, old_result, new_result)
-            delta = sorted(delta, key=lambda a:a[2], reverse=True)
-            # limit the delta to 5 problems
-            total = len(delta)
-            limit = 5
-            cut = total - limit
-            if cut > 0:
-                delta = delta[:5]
-                delta.append((None, 0, cut))
-
-            delta_bytes = pickle.dumps(delta)
-            update = StatusUpdate(delta=delta_bytes, owner=user)
-            update.put()
-            memcache.delete('updates')
+class ApplyPendingHandler(webapp.RequestHandler):
+    # applies whatever a sync left in its PendingChanges, if it didn't get
+    # round to it itself
+    def post(self):
+        user_solns = UserSolutions.get_by_key_name(self.request.get('user_id'))
+        if user_solns:
+            apply_pending(user_solns.owner)
 
-        self.response.set_status(303)
-        self.response.headers.add_header('Location', '?status=success')
+class SyncTaskHandler(webapp.RequestHandler):
+    def post(self):
+        attempt = int(self.request.headers.get('X-AppEngine-TaskRetryCount', 0))
+        run_sync(self.request.get('user_id'), self.request.get('username'), self.request.get('cookie'), attempt)
+
+# how many problems each page of /problems lists, in three columns
+PROBLEMS_PAGE_SIZE = 150
+
+def fetch_page(query, cursor, size):
+    # returns a page of results from query starting at cursor, and the
+    # cursor for the next page if there is one
+    if cursor:
+        try:
+            query.with_cursor(cursor)
+        except db.BadValueError:
+            pass
+    results = query.fetch(size)
+    next_cursor = query.cursor() if len(results) == size else None
+    return results, next_cursor
+
+def cursor_key(cursor):
+    # cursors can be longer than a memcache key may be
+    return hashlib.md5(cursor).hexdigest() if cursor else 'first'
 
 class ProblemsHandler(webapp.RequestHandler):
     def get(self):
@@ -319,29 +1165,55 @@ class ProblemsHandler(webapp.RequestHandler):
         template_values = standard_template_values()
         template_values['page'] = PROBLEMS
 
-#        result = memcache.get('problems')
-#        if not result:
-#            problems = Problem.all()
-#            problems.order('name')
-#            result = list(problems.run())
-#            memcache.add('problems', result)
-        result = get_problems_for_user(users.get_current_user())
-
-        total = len(result)
-        third = total/3
-        two_third = 2*third
-
-        if total % 3 == 1:
-            third += 1
-            two_third += 1
-        elif total % 3 == 2:
-            third += 1
-            two_third += 2
-
-        template_values['problems'] = (result[:third], result[third:two_third], result[two_third:])
-        template_values['no_problems'] = (total == 0)
-
-        self.response.out.write(template.render(HTML_PATH, template_values))
+        user = users.get_current_user()
+        try:
+            offset = max(int(self.request.get('s', 0)), 0)
+        except ValueError:
+            offset = 0
+
+        def render_list():
+            problems = get_problems_for_user(user)
+            result = problems[offset:offset+PROBLEMS_PAGE_SIZE]
+            total = len(result)
+            third = total/3
+            two_third = 2*third
+
+            if total % 3 == 1:
+                third += 1
+                two_third += 1
+            elif total % 3 == 2:
+                third += 1
+                two_third += 2
+
+            return total, render(PROBLEM_LIST_TEMPLATE, {
+                'problems': (result[:third], result[third:two_third], result[two_third:]),
+                'previous_url': offset and '/problems?s=%d' % max(offset-PROBLEMS_PAGE_SIZE, 0),
+                'next_url': offset+PROBLEMS_PAGE_SIZE < len(problems) and '/problems?s=%d' % (offset+PROBLEMS_PAGE_SIZE),
+            })
+
+        total, template_values['problem_list'] = cache.get('problem-list-%s-%d' % (user.user_id(), offset), render_list, namespace=user_namespace(user))
+        template_values['no_problems'] = (total == 0 and not offset)
+
+        write_page(self, template_values)
+
+# how many solvers each page of a problem lists
+SOLVERS_PAGE_SIZE = 50
+# the index solvers are listed from is only eventually consistent, so pages
+# of it aren't kept for long
+SOLVERS_TTL = 60
+
+def get_solvers(prob_id, cursor, size):
+    # returns a page of (username, result) for everyone who's attempted the
+    # problem, best result then username first, and the cursor for the next
+    # page if there is one
+    query = Solution.all().filter('prob_id =', int(prob_id)).filter('listed_result >=', 0)
+    query.order('-listed_result').order('username')
+    solns, next_cursor = fetch_page(query, cursor, size)
+    return [(soln.username, soln.listed_result) for soln in solns], next_cursor
+
+def has_problem(user, prob_id):
+    # whether the user has the problem on orac at all
+    return int(prob_id) in [soln.prob_id for soln in get_solutions_for_user(user)]
 
 class ProblemHandler(webapp.RequestHandler):
     def get(self):
@@ -351,7 +1223,7 @@ class ProblemHandler(webapp.RequestHandler):
         template_values = standard_template_values()
         template_values['page'] = PROBLEM
 
-        prob_id = self.request.url.split('/')[-1]
+        prob_id = self.request.path.split('/')[-1]
         template_values['debug'] = prob_id
 
         if prob_id.isdigit():
@@ -362,46 +1234,72 @@ class ProblemHandler(webapp.RequestHandler):
         if problem:
             template_values['problem'] = problem
 
-            # get solutions
-            key = 'solutions-' + prob_id
-            result = memcache.get(key)
-            if not result:
-                solns = Solution.all()
-                solns.filter('prob_id =', int(prob_id))
-                result = list(solns.run())
-                memcache.add(key, result)
+            stats = get_problem_stats(prob_id)
 
             # do we have access?
-            access = False
-            user = users.get_current_user()
-            for soln in result:
-                if soln.owner == user:
-                    access = True
-                    break
-
-            solved, unsolved, unattempted = 0, 0, 0
-            scores = dict()
-            nice_solns = list()
-            for soln in result:
-                if not (not soln.solve_date and soln.result == 0):
-                    if soln.result == 100:
-                        solved += 1
-                    else:
-                        unsolved += 1
-                    if soln.result not in scores:
-                        scores[soln.result] = 0
-                    scores[soln.result] += 1
-                    nice_solns.append((get_user_data(soln.owner).orac_username, soln.result))
-                else:
-                    unattempted += 1
-            template_values['solved'] = solved
-            template_values['unsolved'] = unsolved
-            template_values['unattempted'] = unattempted
-            template_values['scores'] = [(result, scores[result]) for result in sorted(scores, reverse=True)]
-            template_values['solns'] = sorted(nice_solns, cmp=lambda a,b: cmp(b[1],a[1]) if a[1]!=b[1] else cmp(a[0],b[0]))
+            access = has_problem(users.get_current_user(), prob_id)
+
+            template_values['solved'] = stats.solved
+            template_values['unsolved'] = stats.unsolved
+            template_values['unattempted'] = stats.unattempted
+            template_values['scores'] = [(result, stats.scores[result]) for result in xrange(100, -1, -1) if stats.scores[result]]
             template_values['access'] = access
 
-        self.response.out.write(template.render(HTML_PATH, template_values))
+            # the table only changes when the problem's stats do, apart from
+            # the viewer's own row being highlighted
+            username = template_values['username']
+            cursor = self.request.get('c')
+            table_key = 'solutions-table-%s-%d-%s-%s' % (prob_id, stats.version, username, cursor_key(cursor))
+
+            def render_table():
+                solns, next_cursor = get_solvers(prob_id, cursor, SOLVERS_PAGE_SIZE)
+                return render(SOLUTIONS_TABLE_TEMPLATE, {
+                    'solns': solns,
+                    'username': username,
+                    'first_url': cursor and '/problem/%s' % prob_id,
+                    'next_url': next_cursor and '/problem/%s?c=%s' % (prob_id, next_cursor),
+                })
+            template_values['solutions_table'] = cache.get(table_key, render_table, SOLVERS_TTL)
+
+            write_page(self, template_values, stats.updated)
+            return
+
+        write_page(self, template_values)
+
+# most users that can be compared at once
+MAX_COMPARE = 10
+# most usernames a search returns
+SEARCH_LIMIT = 10
+
+def search_usernames(prefix):
+    # the first SEARCH_LIMIT usernames starting with prefix, in order, read
+    # off the orac_username index
+    prefix = prefix.lower()
+    if not re.match(r'^[a-z0-9]+$', prefix):
+        return []
+
+    def load():
+        query = UserData.all().filter('orac_username >=', prefix).filter('orac_username <', prefix + u'\ufffd').order('orac_username')
+        return [data.orac_username for data in query.fetch(SEARCH_LIMIT)]
+    return cache.get('search-' + prefix, load, namespace='users', local_ttl=cache.LOCAL_TTL)
+
+def find_users(usernames):
+    # maps each of the orac usernames that belongs to someone to their UserData
+    found = dict()
+    for i in xrange(0, len(usernames), 30):
+        for data in UserData.all().filter('orac_username IN', usernames[i:i+30]).run():
+            found[data.orac_username] = data
+    return found
+
+def compare_vectors(vectors):
+    # returns the number of problems everyone has, a (common problems
+    # solved, problems solved, problems) triple for each user, and the ids of
+    # the common problems on which they don't all agree
+    common = vectors[0].present
+    for vector in vectors[1:]:
+        common &= vector.present
+    counts = [(popcount(vector.solved & common), popcount(vector.solved), vector.total) for vector in vectors]
+    return popcount(common), counts, differing_many(vectors, common)
 
 class CompareHandler(webapp.RequestHandler):
     def get(self, extra_values=None, request_handled=False):
@@ -409,30 +1307,19 @@ class CompareHandler(webapp.RequestHandler):
             return
 
         if self.request.get('them') and not request_handled:
+            if len(self.request.get_all('them')) > 1:
+                return self.compare_many()
             return self.post()
 
         template_values = standard_template_values()
         template_values['page'] = COMPARE
 
-        # fetch all users
-        users = memcache.get('users')
-        if not users:
-            users = UserData.all().filter('orac_username !=', None).order('orac_username')
-            users = list(users.run())
-            memcache.add('users', users)
-
-        real_users = []
-        data = get_user_data()
-        for user in users:
-            if user.orac_username != data.orac_username:
-                real_users.append(user)
-
-        template_values['users'] = real_users
+        # users are picked with /api/users as they're typed
         if extra_values:
             for key in extra_values:
                 template_values[key] = extra_values[key]
 
-        self.response.out.write(template.render(HTML_PATH, template_values))
+        write_page(self, template_values)
 
     def post(self):
         if not has_problems_check(self):
@@ -445,85 +1332,661 @@ class CompareHandler(webapp.RequestHandler):
             our_data = get_user_data()
             their_data = data[0]
 
-            #our_solns = Solution.all().filter('owner =', our_data.owner).run()
-            #their_solns = Solution.all().filter('owner =', their_data.owner).run()
-            our_solns = get_solutions_for_user(our_data.owner)
-            their_solns = get_solutions_for_user(their_data.owner)
+            ours, theirs = get_score_vectors([our_data.owner, their_data.owner])
 
-            our_solns_dict = dict()
-            their_solns_dict = dict()
+            common = ours.present & theirs.present
+            common_total = popcount(common)
+            us_common_count = popcount(ours.solved & common)
+            them_common_count = popcount(theirs.solved & common)
 
-            for soln in their_solns:
-                their_solns_dict[soln.prob_id] = soln
+            us_all_count = popcount(ours.solved)
+            them_all_count = popcount(theirs.solved)
+            us_all_total = ours.total
+            them_all_total = theirs.total
 
-            us_all_count = 0
-            us_common_count = 0
-            them_all_count = 0
-            them_common_count = 0
-            common_total = 0
+            table = list()
+            for problem in get_problems(ours.differing(theirs, common)):
+                table.append((problem, ours.result_string(problem.prob_id), theirs.result_string(problem.prob_id)))
+            table = sorted(table, key=lambda a:a[0].name)
+            extra_values = dict()
+            extra_values['table'] = table
+            extra_values['us'] = our_data.orac_username
+            extra_values['them'] = their_data.orac_username
+            extra_values['us_common'] = '%d/%d (%.2f%%)' % (us_common_count, common_total, (us_common_count*100)/float(common_total)) if common_total else '0/0'
+            extra_values['them_common'] = '%d/%d (%.2f%%)' % (them_common_count, common_total, (them_common_count*100)/float(common_total)) if common_total else '0/0'
+            extra_values['us_total'] = '%d/%d (%.2f%%)' % (us_all_count, us_all_total, (us_all_count*100)/float(us_all_total)) if us_all_total else '0/0'
+            extra_values['them_total'] = '%d/%d (%.2f%%)' % (them_all_count, them_all_total, (them_all_count*100)/float(them_all_total)) if them_all_total else '0/0'
+            self.get(extra_values, True)
+        else:
+            self.response.out.write("Bad username, go away.")
 
-            us_all_total = len(our_solns)
-            them_all_total = len(their_solns)
+    def compare_many(self):
+        usernames = list()
+        for username in self.request.get_all('them'):
+            if username not in usernames:
+                usernames.append(username)
+        if len(usernames) > MAX_COMPARE:
+            self.response.out.write("Too many users, go away.")
+            return
 
-            delta = dict()
-            for soln in our_solns:
-                if soln.prob_id in their_solns_dict:
-                    our_result = soln.result
-                    their_result = their_solns_dict[soln.prob_id].result
-                    if our_result != their_result:
-                        our_date = soln.solve_date
-                        their_date = their_solns_dict[soln.prob_id].solve_date
+        found = find_users(usernames)
+        if len(found) != len(usernames):
+            self.response.out.write("Bad username, go away.")
+            return
 
-                        problem = get_problem(soln.prob_id)
+        our_data = get_user_data()
+        if our_data.orac_username not in found:
+            usernames.insert(0, our_data.orac_username)
+            found[our_data.orac_username] = our_data
 
-                        if not our_date and our_result == 0:
-                            our_string = 'Not attempted'
-                        else:
-                            our_string = '%d%%' % our_result
+        vectors = get_score_vectors([found[username].owner for username in usernames])
+        common_total, counts, differing = compare_vectors(vectors)
 
-                        if not their_date and their_result == 0:
-                            their_string = 'Not attempted'
-                        else:
-                            their_string = '%d%%' % their_result
+        summary = list()
+        for username, (common_count, all_count, total) in zip(usernames, counts):
+            summary.append((username,
+                '%d/%d (%.2f%%)' % (common_count, common_total, (common_count*100)/float(common_total)) if common_total else '0/0',
+                '%d/%d (%.2f%%)' % (all_count, total, (all_count*100)/float(total)) if total else '0/0'))
 
-                        delta[soln.prob_id] = (problem, our_string, their_string)
+        table = list()
+        for problem in get_problems(differing):
+            table.append((problem, [vector.result_string(problem.prob_id) for vector in vectors]))
+        table = sorted(table, key=lambda a:a[0].name)
 
-                    if our_result == 100:
-                        us_common_count += 1
-                    if their_result == 100:
-                        them_common_count += 1
-                    common_total += 1
+        extra_values = dict()
+        extra_values['many'] = usernames
+        extra_values['summary'] = summary
+        extra_values['table'] = table
+        self.get(extra_values, True)
 
-                if soln.result == 100:
-                    us_all_count += 1
+class LeaderboardHandler(webapp.RequestHandler):
+    def get(self):
+        if not has_problems_check(self):
+            return
 
-            for soln in their_solns:
-                if soln.result == 100:
-                    them_all_count += 1
+        template_values = standard_template_values()
+        template_values['page'] = LEADERBOARD
+
+        template_values['leaderboard'] = rank_leaderboard(get_leaderboard())
+        template_values['max_compare'] = MAX_COMPARE
+
+        summary = UserSummary.get_by_key_name(userdata_key_name(users.get_current_user()))
+        if summary:
+            template_values['summary'] = summary
+            template_values['rank'], template_values['rank_exact'] = get_rank(summary)
+
+        write_page(self, template_values)
+
+# how many problems the progress page lists as the month's most solved
+TOP_PROBLEMS = 10
+
+def weekly_totals(day_counts):
+    # turns {date: solves} into (start of week, solves up to the end of that
+    # week) pairs, oldest first
+    weeks = dict()
+    for date, count in day_counts.iteritems():
+        week = date - datetime.timedelta(days=date.weekday())
+        weeks[week] = weeks.get(week, 0) + count
+    total = 0
+    totals = list()
+    for week in sorted(weeks):
+        total += weeks[week]
+        totals.append((week, total))
+    return totals
+
+def get_site_progress():
+    def load():
+        day_counts = dict()
+        for bucket in DailySolves.all().run(batch_size=1000):
+            day_counts[bucket.date] = day_counts.get(bucket.date, 0) + bucket.solves
+        return weekly_totals(day_counts)
+    return cache.get('site-progress', load, namespace='rollups', local_ttl=cache.LOCAL_TTL)
+
+def get_top_problems(month):
+    # the most solved problems since the start of month, as (problem, solves)
+    def load():
+        totals = dict()
+        for bucket in DailySolves.all().filter('date >=', month).run():
+            for prob_id, count in unpack_counts(bucket.counts).iteritems():
+                totals[prob_id] = totals.get(prob_id, 0) + count
+        top = sorted(totals.items(), key=lambda a:a[1], reverse=True)[:TOP_PROBLEMS]
+        problems = get_problems([prob_id for prob_id, _ in top])
+        return [(problem, count) for problem, (_, count) in zip(problems, top) if problem]
+    return cache.get('top-problems-' + month.isoformat(), load, namespace='rollups', local_ttl=cache.LOCAL_TTL)
+
+def get_user_progress(user):
+    # a user's own solves are all in their UserSolutions, so they're counted
+    # from there rather than from the rollups
+    def load():
+        changes = dict()
+        count_solves(get_solutions_for_user(user), changes)
+        return weekly_totals(dict([(date, sum(counts.values())) for date, counts in changes.iteritems()]))
+    return cache.get('progress-' + user.user_id(), load, namespace=user_namespace(user))
+
+class ProgressHandler(webapp.RequestHandler):
+    def get(self):
+        if not has_problems_check(self):
+            return
 
-            table = sorted(delta.values(), key=lambda a:a[0].name)
-            extra_values = dict()
-            extra_values['table'] = table
-            extra_values['us'] = our_data.orac_username
-            extra_values['them'] = their_data.orac_username
-            extra_values['us_common'] = '%d/%d (%.2f%%)' % (us_common_count, common_total, (us_common_count*100)/float(common_total))
-            extra_values['them_common'] = '%d/%d (%.2f%%)' % (them_common_count, common_total, (them_common_count*100)/float(common_total))
-            extra_values['us_total'] = '%d/%d (%.2f%%)' % (us_all_count, us_all_total, (us_all_count*100)/float(us_all_total))
-            extra_values['them_total'] = '%d/%d (%.2f%%)' % (them_all_count, them_all_total, (them_all_count*100)/float(them_all_total))
-            self.get(extra_values, True)
+        template_values = standard_template_values()
+        template_values['page'] = PROGRESS
+
+        month = datetime.date.today().replace(day=1)
+        template_values['user_progress'] = get_user_progress(users.get_current_user())
+        template_values['site_progress'] = get_site_progress()
+        template_values['top_problems'] = get_top_problems(month)
+        template_values['month'] = month
+
+        write_page(self, template_values)
+
+# users looked at per page of a bulk re-sync
+RESYNC_PAGE_SIZE = 50
+# at most this many fetches from orac at once; the rate is ORAC_RATE, shared
+# with everyone else's syncs, and only one re-sync task runs at a time (see
+# queue.yaml)
+RESYNC_WORKERS = 4
+# a task stops taking on new pages after this many seconds, leaving room
+# before the task deadline to checkpoint and queue the next one
+RESYNC_BUDGET = 8*60
+# an unfinished run that hasn't checkpointed for this long is assumed dead
+RESYNC_TIMEOUT = datetime.timedelta(hours=1)
+
+def resync_page(run, limiter):
+    # re-syncs one page of users, recording progress on run; returns False
+    # once there are no more users
+    query = UserData.all().filter('orac_username >', '')
+    if run.cursor:
+        query.with_cursor(run.cursor)
+    page = query.fetch(RESYNC_PAGE_SIZE)
+
+    sessions = [session for session in OracSession.get_by_key_name([data.key().name() for data in page]) if session]
+    by_owner = dict([(data.owner.user_id(), data) for data in page])
+
+    start = time.time()
+    results = orac_client.fetch_many([session.cookie for session in sessions], RESYNC_WORKERS, limiter)
+    run.fetch_time += time.time() - start
+
+    start = time.time()
+    expired = list()
+    for session, result in zip(sessions, results):
+        if result is False:
+            # orac has forgotten about this cookie
+            expired.append(session)
+            run.expired += 1
+        elif isinstance(result, Exception):
+            logging.error('Re-sync fetch failed for %s: %r', by_owner[session.owner.user_id()].orac_username, result)
+            run.failed += 1
         else:
-            self.response.out.write("Bad username, go away.")
+            run.fetched += 1
+            try:
+                if apply_stats(session.owner, by_owner[session.owner.user_id()].orac_username, result):
+                    run.changed += 1
+            except Exception:
+                logging.exception('Re-sync apply failed for %s', by_owner[session.owner.user_id()].orac_username)
+                run.failed += 1
+    if expired:
+        db.delete(expired)
+    run.apply_time += time.time() - start
+
+    run.users += len(page)
+    run.cursor = query.cursor()
+    return len(page) == RESYNC_PAGE_SIZE
+
+class ResyncHandler(webapp.RequestHandler):
+    # re-syncs every user who's left an orac session with us, a page at a
+    # time, checkpointing after each page so it can pick up where it left
+    # off in a new task
+    def get(self):
+        # started by cron
+        running = ResyncRun.all().filter('finished =', None).fetch(1)
+        if running and running[0].updated > datetime.datetime.now() - RESYNC_TIMEOUT:
+            self.response.out.write('Re-sync already running.')
+            return
+        run = ResyncRun()
+        run.put()
+        taskqueue.add(queue_name='resync', url='/_tasks/resync', params={'run': run.key().id()})
+        self.response.out.write('Re-sync started.')
+
+    def post(self):
+        run = ResyncRun.get_by_id(int(self.request.get('run')))
+        if not run or run.finished:
+            return
+
+        start = time.time()
+        more = True
+        while more and time.time() - start < RESYNC_BUDGET:
+            more = resync_page(run, orac_limiter)
+            run.put()
+            logging.info('Re-sync %d: %d users, %d fetched, %d changed, %d expired, %d failed; %.1fs fetching, %.1fs applying',
+                run.key().id(), run.users, run.fetched, run.changed, run.expired, run.failed, run.fetch_time, run.apply_time)
+
+        if more:
+            taskqueue.add(queue_name='resync', url='/_tasks/resync', params={'run': run.key().id()})
+        else:
+            run.finished = datetime.datetime.now()
+            run.put()
+            elapsed = (run.finished - run.started).total_seconds()
+            logging.info('Re-sync %d finished in %.1fs (%.2f users/s)', run.key().id(), elapsed, run.users/elapsed if elapsed else 0)
+
+# the columns shown on /_stats
+TIMING_CATEGORIES = ['memcache', 'datastore', 'http', 'parse', 'taskqueue']
+
+# most items in a page of an API listing, and most users in one /api/scores
+API_PAGE_SIZE = 100
+API_MAX_USERS = 50
+
+def to_json(payload):
+    return json.dumps(payload, separators=(',', ':'))
+
+class ApiHandler(webapp.RequestHandler):
+    # read-only JSON versions of the pages, for dashboards and scripts
+    def check(self):
+        # like has_problems_check, but answers in JSON rather than redirecting
+        if not users.get_current_user():
+            self.error_json(401, 'login required')
+            return False
+        if not get_user_data().orac_username:
+            self.error_json(403, 'no problems')
+            return False
+        return True
+
+    def error_json(self, status, message, **details):
+        self.response.set_status(status)
+        self.response.headers['Content-Type'] = 'application/json'
+        details['error'] = message
+        self.response.out.write(to_json(details))
+
+    def page_args(self):
+        try:
+            offset = max(int(self.request.get('offset', 0)), 0)
+            limit = min(max(int(self.request.get('limit', API_PAGE_SIZE)), 1), API_PAGE_SIZE)
+        except ValueError:
+            offset, limit = 0, API_PAGE_SIZE
+        return offset, limit
+
+    def write_json(self, body, last_modified=None):
+        write_conditional(self, body, 'application/json', last_modified)
+
+def paginate(items, offset, limit):
+    page = {'items': items[offset:offset+limit]}
+    if offset+limit < len(items):
+        page['next'] = offset+limit
+    return page
+
+class ApiProblemsHandler(ApiHandler):
+    def get(self):
+        if not self.check():
+            return
+
+        user = users.get_current_user()
+        offset, limit = self.page_args()
+
+        def load():
+            problems = [{'id': problem.prob_id, 'name': problem.name} for problem in get_problems_for_user(user)]
+            return to_json(paginate(problems, offset, limit))
+        self.write_json(cache.get('api-problems-%s-%d-%d' % (user.user_id(), offset, limit), load, namespace=user_namespace(user)))
+
+class ApiProblemHandler(ApiHandler):
+    def get(self, prob_id):
+        if not self.check():
+            return
+
+        problem = get_problem(prob_id)
+        if not problem or not has_problem(users.get_current_user(), prob_id):
+            self.error_json(404, 'no such problem')
+            return
+        stats = get_problem_stats(prob_id)
+
+        # solvers are paged by cursor, which is handed back as next
+        limit = self.page_args()[1]
+        cursor = self.request.get('cursor')
+
+        def load():
+            solns, next_cursor = get_solvers(prob_id, cursor, limit)
+            payload = {'items': [{'username': username, 'result': result} for username, result in solns]}
+            if next_cursor:
+                payload['next'] = next_cursor
+            payload.update({
+                'id': problem.prob_id,
+                'name': problem.name,
+                'solved': stats.solved,
+                'unsolved': stats.unsolved,
+                'unattempted': stats.unattempted,
+                'scores': dict([(str(result), stats.scores[result]) for result in xrange(101) if stats.scores[result]]),
+            })
+            return to_json(payload)
+        self.write_json(cache.get('api-problem-%s-%d-%s-%d' % (prob_id, stats.version, cursor_key(cursor), limit), load, SOLVERS_TTL), stats.updated)
+
+class ApiCompareHandler(ApiHandler):
+    def get(self):
+        if not self.check():
+            return
+
+        usernames = list()
+        for username in [get_user_data().orac_username] + self.request.get_all('them'):
+            if username not in usernames:
+                usernames.append(username)
+        if len(usernames) > MAX_COMPARE + 1:
+            self.error_json(400, 'too many users')
+            return
+        found = find_users(usernames)
+        if len(found) != len(usernames):
+            self.error_json(404, 'no such user', users=[username for username in usernames if username not in found])
+            return
+        owners = [found[username].owner for username in usernames]
+
+        def load():
+            vectors = get_score_vectors(owners)
+            common_total, counts, differing = compare_vectors(vectors)
+            problems = list()
+            for problem in get_problems(differing):
+                results = [vector.result(problem.prob_id) for vector in vectors]
+                problems.append({'id': problem.prob_id, 'name': problem.name, 'results': dict(zip(usernames, results))})
+
+            return to_json({
+                'common': common_total,
+                'users': [{'username': username, 'common_solved': common_count, 'solved': all_count, 'problems': total}
+                          for username, (common_count, all_count, total) in zip(usernames, counts)],
+                'differing': sorted(problems, key=lambda a:a['name']),
+            })
+        # a comparison changes whenever any of its users syncs, so it's
+        # keyed by every one of their namespaces' generations
+        versions = cache.versioned_multi(['compare'] * len(owners), [user_namespace(owner) for owner in owners])
+        key = 'api-compare-' + hashlib.md5('\n'.join(usernames + versions)).hexdigest()
+        self.write_json(cache.get(key, load))
+
+class ApiFeedHandler(ApiHandler):
+    # paged by cursor, which is handed back as next; timestamps are ISO 8601
+    # in UTC
+    def get(self):
+        if not self.check():
+            return
 
-def main():
-    application = webapp.WSGIApplication([
+        limit = min(self.page_args()[1], FEED_MAX_LENGTH)
+        updates, next_cursor = get_feed(self.request.get('cursor'), limit)
+        payload = {'items': [{'timestamp': timestamp.isoformat() + 'Z', 'text': render_update(username, achievements)}
+                             for timestamp, username, achievements in updates]}
+        if next_cursor:
+            payload['next'] = next_cursor
+        self.write_json(to_json(payload))
+
+class ApiUsersHandler(ApiHandler):
+    # usernames starting with q, other than the current user's, for the
+    # search box on /compare
+    def get(self):
+        if not self.check():
+            return
+
+        ours = get_user_data().orac_username
+        usernames = [username for username in search_usernames(self.request.get('q')) if username != ours]
+        self.write_json(to_json(usernames))
+
+class ApiScoresHandler(ApiHandler):
+    # every requested user's results in one go, as
+    # {username: {prob_id: result}}, where a result of -1 means unattempted
+    def get(self):
+        if not self.check():
+            return
+
+        usernames = list()
+        for username in self.request.get('users').split(','):
+            if username and username not in usernames:
+                usernames.append(username)
+        if len(usernames) > API_MAX_USERS:
+            self.error_json(400, 'too many users')
+            return
+
+        found = find_users(usernames)
+        if len(found) != len(usernames):
+            self.error_json(404, 'no such user', users=[username for username in usernames if username not in found])
+            return
+        owners = [found[username].owner for username in usernames]
+        keys = cache.versioned_multi(['api-scores-' + owner.user_id() for owner in owners], [user_namespace(owner) for owner in owners])
+
+        def load(missing):
+            # serialise each user's vector on its own, so the response can be
+            # stitched together from cached pieces
+            by_key = dict(zip(keys, owners))
+            vectors = get_score_vectors([by_key[key] for key in missing])
+            return dict([(key, to_json(dict([(str(prob_id), result) for prob_id, result in vector.results()])))
+                         for key, vector in zip(missing, vectors)])
+        cached = cache.get_multi(keys, load)
+
+        parts = ['%s:%s' % (json.dumps(username), cached[key]) for username, key in zip(usernames, keys)]
+        self.write_json('{' + ','.join(parts) + '}')
+
+class TimingsHandler(webapp.RequestHandler):
+    # what this instance has been spending its time on lately
+    def get(self):
+        template_values = standard_template_values()
+        template_values['page'] = TIMINGS
+        template_values['categories'] = TIMING_CATEGORIES
+
+        rows = list()
+        for method, path, n, p50, p95, categories in instrument.summarise():
+            columns = ['%.1f / %.1fms' % categories[category] if category in categories else '' for category in TIMING_CATEGORIES]
+            rows.append((method, path, n, '%.1fms' % p50, '%.1fms' % p95, columns))
+        template_values['rows'] = rows
+
+        write_page(self, template_values)
+
+MIGRATE_BATCH_SIZE = 100
+
+class ReserveUsernamesHandler(webapp.RequestHandler):
+    # reserves each username taken before usernames were reserved for the
+    # user who has it, a batch of users at a time, queueing a task for each
+    # following batch; a username someone else has reserved since is left
+    # alone, and logged
+    def get(self):
+        taskqueue.add(url='/_admin/reserve-usernames')
+        self.response.out.write('Username reservation started.')
+
+    def post(self):
+        query = UserData.all().filter('orac_username >', '')
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        batch = query.fetch(MIGRATE_BATCH_SIZE)
+
+        for data in batch:
+            if not reserve_username(data.orac_username, data.owner):
+                logging.warning('%s is reserved by someone other than %s', data.orac_username, data.owner.user_id())
+
+        if len(batch) == MIGRATE_BATCH_SIZE:
+            taskqueue.add(url='/_admin/reserve-usernames', params={'cursor': query.cursor()})
+
+class BuildProblemStatsHandler(webapp.RequestHandler):
+    # builds shard 0 of the ProblemStats of every problem that predates the
+    # aggregate, from its solutions, a batch of problems at a time, queueing
+    # a task for each following batch; it's safe to run again, as a shard 0
+    # that's there is left alone
+    def get(self):
+        taskqueue.add(url='/_admin/build-problem-stats')
+        self.response.out.write('Problem stats build started.')
+
+    def post(self):
+        query = Problem.all(keys_only=True)
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        batch = query.fetch(MIGRATE_BATCH_SIZE)
+
+        prob_ids = [int(key.name()) for key in batch]
+        missing = [prob_id for prob_id, stats in zip(prob_ids, ProblemStats.get_by_key_name([problem_stats_key_name(prob_id) for prob_id in prob_ids])) if not stats]
+        for prob_id in missing:
+            build_problem_stats(prob_id)
+        forget_problem_stats(missing)
+
+        if len(batch) == MIGRATE_BATCH_SIZE:
+            taskqueue.add(url='/_admin/build-problem-stats', params={'cursor': query.cursor()})
+
+class BuildSummariesHandler(webapp.RequestHandler):
+    # builds the UserSummary of everyone who hasn't synced since summaries
+    # were kept, from their solutions, a batch of users at a time, queueing
+    # a task for each following batch; it's safe to run alongside syncs, or
+    # again, as a summary is only written if it's changed
+    def get(self):
+        taskqueue.add(url='/_admin/build-summaries')
+        self.response.out.write('Summary build started.')
+
+    def post(self):
+        query = UserData.all().filter('orac_username >', '')
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        batch = query.fetch(MIGRATE_BATCH_SIZE)
+
+        summaries = UserSummary.get_by_key_name([userdata_key_name(data.owner) for data in batch])
+        missing = [data for data, summary in zip(batch, summaries) if not summary]
+        for data, packed in zip(missing, load_user_solutions([data.owner for data in missing])):
+            update_user_summary(data.owner, data.orac_username, [(soln.result, soln.solve_date) for soln in unpack_solutions(packed)])
+
+        if len(batch) == MIGRATE_BATCH_SIZE:
+            taskqueue.add(url='/_admin/build-summaries', params={'cursor': query.cursor()})
+
+class PackSolutionsHandler(webapp.RequestHandler):
+    # packs the Solution entities of everyone who hasn't synced since
+    # solutions were packed into their UserSolutions, a batch of users at a
+    # time, queueing a task for each following batch; a sync that gets to
+    # someone first packs them itself, and isn't overwritten
+    def get(self):
+        taskqueue.add(url='/_admin/pack-solutions')
+        self.response.out.write('Solution packing started.')
+
+    def post(self):
+        query = UserData.all().filter('orac_username >', '')
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        batch = query.fetch(MIGRATE_BATCH_SIZE)
+
+        entities = UserSolutions.get_by_key_name([userdata_key_name(data.owner) for data in batch])
+        owners = [data.owner for data, entity in zip(batch, entities) if not entity]
+        if owners:
+            prob_ids = [int(key.name()) for key in Problem.all(keys_only=True)]
+        for owner in owners:
+            packed = pack_legacy_solutions(owner, prob_ids)
+            # someone with nothing to count is already rolled up
+            UserSolutions.get_or_insert(userdata_key_name(owner), owner=owner, packed=packed, rolled_up=not packed)
+            cache.bump(user_namespace(owner))
+
+        if len(batch) == MIGRATE_BATCH_SIZE:
+            taskqueue.add(url='/_admin/pack-solutions', params={'cursor': query.cursor()})
+
+class BackfillRollupsHandler(webapp.RequestHandler):
+    # counts everyone's existing solves into DailySolves, a batch of users
+    # at a time, queueing a task for each following batch; users are marked
+    # as they're counted, in the same transaction as their solves are added
+    # to their PendingChanges, so it's safe to run alongside syncs, or again
+    def get(self):
+        taskqueue.add(url='/_admin/backfill-rollups')
+        self.response.out.write('Rollup backfill started.')
+
+    def post(self):
+        query = UserData.all().filter('orac_username >', '')
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        batch = query.fetch(MIGRATE_BATCH_SIZE)
+
+        def txn(key_name):
+            user_solns = UserSolutions.get_by_key_name(key_name)
+            if user_solns.rolled_up:
+                return
+            user_solns.rolled_up = True
+            changes = dict()
+            count_solves(unpack_solutions(user_solns.packed), changes)
+            pending = db.get(pending_key(user_solns.owner)) or PendingChanges(key_name='pending', parent=user_solns)
+            add_pending(pending, [], {}, changes)
+            db.put([user_solns] + ([] if pending.empty() else [pending]))
+
+        # anyone whose solutions haven't been packed yet is left to
+        # PackSolutionsHandler, which should be run first
+        for user_solns in UserSolutions.get_by_key_name([userdata_key_name(data.owner) for data in batch]):
+            if user_solns:
+                db.run_in_transaction(txn, user_solns.key().name())
+                apply_pending(user_solns.owner)
+
+        if len(batch) == MIGRATE_BATCH_SIZE:
+            taskqueue.add(url='/_admin/backfill-rollups', params={'cursor': query.cursor()})
+
+class MigrateSolutionUsernamesHandler(webapp.RequestHandler):
+    # copies each owner's orac username and the listed result onto the
+    # solutions stored before they had them, so they show up in their
+    # problems' lists of solvers
+    def get(self):
+        taskqueue.add(url='/_admin/migrate-solution-usernames')
+        self.response.out.write('Solution username migration started.')
+
+    def post(self):
+        query = Solution.all()
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        batch = query.fetch(MIGRATE_BATCH_SIZE)
+
+        changed = list()
+        for soln, data in zip(batch, get_user_data_multi([soln.owner for soln in batch])):
+            if soln.listed_result is None and data and data.orac_username:
+                soln.username = data.orac_username
+                soln.listed_result = solution_result(soln.result, soln.solve_date)
+                changed.append(soln)
+        if changed:
+            db.put(changed)
+
+        if len(batch) == MIGRATE_BATCH_SIZE:
+            taskqueue.add(url='/_admin/migrate-solution-usernames', params={'cursor': query.cursor()})
+
+class MigrateDeltasHandler(webapp.RequestHandler):
+    # rewrites pickled StatusUpdate deltas in the current encoding, a batch
+    # at a time, queueing a task for each following batch
+    def get(self):
+        taskqueue.add(url='/_admin/migrate-deltas')
+        self.response.out.write('Delta migration started.')
+
+    def post(self):
+        query = StatusUpdate.all()
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        batch = query.fetch(MIGRATE_BATCH_SIZE)
+
+        changed = list()
+        for update in batch:
+            if not update.delta.startswith('{'):
+                update.delta = encode_delta(*decode_delta(update.delta))
+                changed.append(update)
+        if changed:
+            db.put(changed)
+
+        if len(batch) == MIGRATE_BATCH_SIZE:
+            taskqueue.add(url='/_admin/migrate-deltas', params={'cursor': query.cursor()})
+
+instrument.install_hooks()
+
+app = InstrumentMiddleware(MemoMiddleware(webapp.WSGIApplication([
         (HOME.url, HomeHandler),
         (UPDATE.url, UpdateHandler),
         (COMPARE.url, CompareHandler),
         (PROBLEMS.url, ProblemsHandler),
         (PROBLEM.url, ProblemHandler),
-        ], debug=True)
-    util.run_wsgi_app(application)
-
-
-if __name__ == '__main__':
-    main()
+        (LEADERBOARD.url, LeaderboardHandler),
+        (PROGRESS.url, ProgressHandler),
+        ('/api/problems', ApiProblemsHandler),
+        ('/api/problem/([0-9]+)', ApiProblemHandler),
+        ('/api/compare', ApiCompareHandler),
+        ('/api/feed', ApiFeedHandler),
+        ('/api/scores', ApiScoresHandler),
+        ('/api/users', ApiUsersHandler),
+        ('/_admin/migrate-deltas', MigrateDeltasHandler),
+        ('/_admin/migrate-solution-usernames', MigrateSolutionUsernamesHandler),
+        ('/_admin/reserve-usernames', ReserveUsernamesHandler),
+        ('/_admin/pack-solutions', PackSolutionsHandler),
+        ('/_admin/build-summaries', BuildSummariesHandler),
+        ('/_admin/build-problem-stats', BuildProblemStatsHandler),
+        ('/_admin/backfill-rollups', BackfillRollupsHandler),
+        ('/_tasks/sync', SyncTaskHandler),
+        ('/_tasks/apply-pending', ApplyPendingHandler),
+        ('/_tasks/resync', ResyncHandler),
+        (TIMINGS.url, TimingsHandler),
+        ], debug=True)))
@@ -0,0 +1,56 @@
+import collections
+import logging
+import threading
+
+class RequestMemo(threading.local):
+    # an identity map of everything looked up while handling a request, so
+    # each thing is fetched from memcache or the datastore at most once per
+    # request; fetches counts the lookups that went past the memo, by kind
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.values = collections.defaultdict(dict)
+        self.fetches = collections.defaultdict(int)
+
+    def get(self, kind, key, loader):
+        values = self.values[kind]
+        if key not in values:
+            self.fetches[kind] += 1
+            values[key] = loader()
+        return values[key]
+
+    def get_multi(self, kind, keys, loader):
+        # loader is called with the keys that aren't memoised yet and returns
+        # a dict of their values; returns a list in the same order as keys
+        values = self.values[kind]
+        missing = [key for key in keys if key not in values]
+        if missing:
+            self.fetches[kind] += 1
+            loaded = loader(missing)
+            for key in missing:
+                values[key] = loaded.get(key)
+        return [values[key] for key in keys]
+
+    def set(self, kind, key, value):
+        self.values[kind][key] = value
+
+    def forget(self, kind, key):
+        self.values[kind].pop(key, None)
+
+memo = RequestMemo()
+
+class MemoMiddleware(object):
+    # gives each request a fresh memo, logging how many fetches it made
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        memo.clear()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            if memo.fetches:
+                logging.debug('%s %s: %s', environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'),
+                    ', '.join(['%d %s' % (count, kind) for kind, count in sorted(memo.fetches.items())]))
+            memo.clear()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Times the pieces of a sync that don't need the App Engine stubs, against
+# the implementations they replaced.
+#
+#     python microbench.py parser --rows 2000
+#     python microbench.py deltas --sdk ~/google_appengine
+#     python microbench.py orac --users 200
+#
+import StringIO
+import argparse
+import datetime
+import pickle
+import random
+import re
+import timeit
+
+def hub_page(rows, seed=0):
+    # a made-up hub page, laid out like orac's: problems grouped into sets,
+    # each set under a header
+    rng = random.Random(seed)
+    parts = ['<html><body><table>\n']
+    for prob_id in xrange(1, rows+1):
+        if prob_id % 25 == 1:
+            set_id = 'set%d' % (prob_id // 25)
+            parts.append('<tr><td colspan="2" class="alert-info"><a name="%s">Set %d</a></td></tr>\n' % (set_id, prob_id // 25))
+        status = rng.choice(['New', 'Viewed', '%d%% (Attempted)' % rng.randint(1, 99),
+            'Finished on %s, 12:%02d' % ((datetime.date(2012, 1, 1) + datetime.timedelta(days=rng.randint(0, 700))).strftime('%a %d %b %Y'), rng.randint(0, 59))])
+        name = rng.choice(['Problem %d', 'Bob&#39;s Problem %d', 'A &amp; B %d']) % prob_id
+        parts.append('<tr><td><a href="problem.pl?set=%s&problemid=%d">%s</a></td><td class="status"> %s </td></tr>\n' % (set_id, prob_id, name, status))
+    parts.append('</table></body></html>\n')
+    return ''.join(parts)
+
+def regex_probs_stats(html_data):
+    # get_probs_stats as it was before the page was parsed incrementally
+    setNames = {}
+    sets = {}
+
+    setPattern = re.compile('class="alert-info"><a name="(.*?)">(.*?)</a>')
+    setResults = setPattern.findall(html_data)
+    for m in setResults:
+        setNames[m[0]] = [m[1], True]
+        sets[m[0]] = []
+
+    probPattern = re.compile('problem.pl\?set=(.*?)\&problemid=(.*?)">(.*?)</a></td><td class=".*?">(.*?)</td>')
+    probResults = probPattern.findall(html_data)
+
+    problems = {}
+
+    scoreRe = re.compile('([0-9]+)%')
+    dateRe = re.compile('Finished on (.*?),')
+
+    for m in probResults:
+        setid = m[0]
+        probid = int(m[1])
+        prob_name = m[2].replace('&#39;',"'")
+        status = m[3].strip()
+
+        sets[setid].append(probid)
+        if status.startswith("Finished"):
+            result = 100
+            solve_date = datetime.datetime.strptime(dateRe.match(status).group(1), '%a %d %b %Y').date()
+        elif status.startswith("New") or status.startswith("Viewed"):
+            result = 0
+            solve_date = None
+        else:
+            result = int(scoreRe.match(status).group(1))
+            solve_date = None
+
+        problems[probid] = (prob_name, result, solve_date)
+
+    return problems
+
+def best(func, number, repeat=5):
+    # milliseconds per call, best of repeat
+    return min(timeit.repeat(func, number=number, repeat=repeat)) * 1000 / number
+
+def bench_parser(args):
+    from stats import get_probs_stats, CHUNK_SIZE
+    page = hub_page(args.rows, args.seed)
+    assert get_probs_stats(StringIO.StringIO(page)) == regex_probs_stats(page)
+    print 'hub page: %d rows, %d bytes' % (args.rows, len(page))
+    print '%-28s %9s' % ('', 'ms/page')
+    print '%-28s %9.2f' % ('regex, whole page', best(lambda: regex_probs_stats(page), args.number))
+    print '%-28s %9.2f' % ('streaming, whole page', best(lambda: get_probs_stats(page), args.number))
+    print '%-28s %9.2f' % ('streaming, %d byte chunks' % CHUNK_SIZE, best(lambda: get_probs_stats(StringIO.StringIO(page)), args.number))
+
+def bench_deltas(args):
+    import bench
+    bench.setup_sdk(args.sdk)
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    import main
+
+    rng = random.Random(args.seed)
+    print '%-8s %8s %8s %14s %14s %14s %14s' % ('entries', 'pickle B', 'json B', 'pickle enc us', 'pickle dec us', 'json enc us', 'json dec us')
+    for size, cut in ((1, 0), (3, 0), (5, 0), (5, 20)):
+        delta = [('Problem %d' % rng.randint(1, 2000), rng.choice([-1, 0, 50]), rng.choice([100, 75])) for _ in xrange(size)]
+        # the old encoding, with its trailer for the entries cut off the end
+        pickled = pickle.dumps(delta + [(None, 0, cut)] if cut else delta)
+        encoded = main.encode_delta(delta, cut)
+        assert main.decode_delta(pickled) == main.decode_delta(encoded) == (delta, cut)
+        number = args.number * 100
+        print '%-8s %8d %8d %14.1f %14.1f %14.1f %14.1f' % ('%d+%d' % (size, cut), len(pickled), len(encoded),
+            best(lambda: pickle.dumps(delta + [(None, 0, cut)] if cut else delta), number) * 1000,
+            best(lambda: main.decode_delta(pickled), number) * 1000,
+            best(lambda: main.encode_delta(delta, cut), number) * 1000,
+            best(lambda: main.decode_delta(encoded), number) * 1000)
+    bed.deactivate()
+
+def bench_orac(args):
+    import threading
+    import time
+    from bench import Dataset, FakeOrac
+    from stats import OracClient
+
+    class UnpooledClient(OracClient):
+        # opens a new connection for every request, as fetch_stats used to
+        def release(self, conn):
+            conn.close()
+
+    orac = FakeOrac(Dataset(args.users, args.rows, 60, args.seed))
+    thread = threading.Thread(target=orac.serve_forever)
+    thread.daemon = True
+    thread.start()
+    cookies = ['aioc_session=' + username for username in orac.dataset.usernames]
+
+    print 'fetching and parsing the hub for %d users from a local fake orac' % len(cookies)
+    print '%-10s %8s %10s %12s' % ('client', 'workers', 'users/s', 'connections')
+    try:
+        for client_class in (UnpooledClient, OracClient):
+            for workers in (1, 4, 8):
+                client = client_class(host=orac.host)
+                start = time.time()
+                results = client.fetch_many(cookies, workers)
+                elapsed = time.time() - start
+                assert results == [orac.dataset.results[username] for username in orac.dataset.usernames]
+                print '%-10s %8d %10.1f %12d' % ('pooled' if client_class is OracClient else 'unpooled', workers,
+                    len(cookies) / elapsed, client.connections_opened)
+    finally:
+        orac.shutdown()
+        orac.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('what', choices=['parser', 'deltas', 'orac'])
+    parser.add_argument('--sdk', help='path to the App Engine SDK, for deltas')
+    parser.add_argument('--rows', type=int, default=2000, help='problems on the hub page')
+    parser.add_argument('--users', type=int, default=200, help='users fetched from orac')
+    parser.add_argument('--number', type=int, default=20, help='runs per timing')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    {'parser': bench_parser, 'deltas': bench_deltas, 'orac': bench_orac}[args.what](args)
+
+if __name__ == '__main__':
+    main()
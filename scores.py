@@ -0,0 +1,113 @@
+import array
+import collections
+import datetime
+
+# score bytes for problems that a user doesn't have, or hasn't attempted
+ABSENT = 255
+UNATTEMPTED = 254
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+def iter_bits(bits):
+    # yields the index of every set bit, lowest first
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+def to_bits(flags):
+    # packs a sequence of booleans into a long, with flags[i] as bit i
+    return long(''.join(['1' if flag else '0' for flag in reversed(flags)]) or '0', 2)
+
+class ScoreVector(object):
+    # a user's results packed into one byte per problem id, along with
+    # bitsets of the problems they have and the problems they've solved
+    def __init__(self, results):
+        # results is a list of (prob_id, result) pairs, where a result of -1
+        # means the problem hasn't been attempted
+        size = max([prob_id for prob_id, _ in results]) + 1 if results else 0
+        scores = array.array('B', [ABSENT]) * size
+        for prob_id, result in results:
+            scores[prob_id] = UNATTEMPTED if result == -1 else result
+
+        self.scores = scores.tostring()
+        self.total = len(results)
+        self.present = to_bits([score != ABSENT for score in scores])
+        self.solved = to_bits([score == 100 for score in scores])
+
+    def result(self, prob_id):
+        # the user's result on a problem they have, -1 if unattempted
+        score = ord(self.scores[prob_id])
+        return -1 if score == UNATTEMPTED else score
+
+    def results(self):
+        # (prob_id, result) for every problem the user has
+        return [(prob_id, self.result(prob_id)) for prob_id in iter_bits(self.present)]
+
+    def result_string(self, prob_id):
+        score = ord(self.scores[prob_id])
+        if score == UNATTEMPTED:
+            return 'Not attempted'
+        return '%d%%' % score
+
+    def differing(self, other, mask):
+        # ids of the problems in mask on which the two users' results differ
+        return [i for i in iter_bits(mask) if self.scores[i] != other.scores[i]]
+
+def differing_many(vectors, mask):
+    # ids of the problems in mask on which the users don't all agree
+    return [i for i in iter_bits(mask) if len(set([vector.scores[i] for vector in vectors])) > 1]
+
+# a user's result on a problem, as unpacked from their UserSolutions
+SolutionRow = collections.namedtuple('SolutionRow', 'prob_id result solve_date')
+
+def pack_solutions(solns):
+    # packs (prob_id, result, solve_date) triples into three ints apiece,
+    # with 0 standing in for no solve date
+    packed = array.array('i')
+    for prob_id, result, solve_date in sorted(solns):
+        packed.extend((prob_id, result, solve_date.toordinal() if solve_date else 0))
+    return packed.tostring()
+
+def unpack_solutions(data):
+    packed = array.array('i')
+    packed.fromstring(data)
+    return [SolutionRow(prob_id, result, datetime.date.fromordinal(ordinal) if ordinal else None)
+            for prob_id, result, ordinal in zip(packed[::3], packed[1::3], packed[2::3])]
+
+def pack_counts(counts):
+    # packs a {prob_id: count} dict into two ints apiece
+    packed = array.array('i')
+    for prob_id, count in sorted(counts.iteritems()):
+        packed.extend((prob_id, count))
+    return packed.tostring()
+
+def unpack_counts(data):
+    packed = array.array('i')
+    packed.fromstring(data)
+    return dict(zip(packed[::2], packed[1::2]))
+
+def pack_nested_counts(counts):
+    # packs a {key: {prob_id: count}} dict, where the keys are ints, into
+    # three ints per count
+    packed = array.array('i')
+    for key, inner in sorted(counts.iteritems()):
+        for prob_id, count in sorted(inner.iteritems()):
+            packed.extend((key, prob_id, count))
+    return packed.tostring()
+
+def unpack_nested_counts(data):
+    packed = array.array('i')
+    packed.fromstring(data)
+    counts = dict()
+    for key, prob_id, count in zip(packed[::3], packed[1::3], packed[2::3]):
+        counts.setdefault(key, dict())[prob_id] = count
+    return counts
+
+def pack_day_counts(days):
+    # packs a {date: {prob_id: count}} dict like pack_nested_counts
+    return pack_nested_counts(dict([(date.toordinal(), counts) for date, counts in days.iteritems()]))
+
+def unpack_day_counts(data):
+    return dict([(datetime.date.fromordinal(ordinal), counts) for ordinal, counts in unpack_nested_counts(data).iteritems()])
@@ -1,42 +1,57 @@
+import Queue
+import array
+import hashlib
 import httplib
+import os
 import urllib
 import re
 import datetime
+import socket
+import threading
+import time
+import zlib
 
-def get_probs_stats(html_data):
-    # maps id to (name, status)
-    setNames = {}
-    sets = {}
+import instrument
 
-    setPattern = re.compile('class="alert-info"><a name="(.*?)">(.*?)</a>')
-    setResults = setPattern.findall(html_data)
-    for m in setResults:
-        setNames[m[0]] = [m[1], True]
-        sets[m[0]] = []
+CHUNK_SIZE = 16384
 
-    # get all problems
-    probPattern = re.compile('problem.pl\?set=(.*?)\&problemid=(.*?)">(.*?)</a></td><td class=".*?">(.*?)</td>')
-    probResults = probPattern.findall(html_data)
+probPattern = re.compile('problem.pl\?set=(.*?)\&problemid=(.*?)">(.*?)</a></td><td class=".*?">(.*?)</td>')
+probPrefix = 'problem.pl?set='
+scoreRe = re.compile('([0-9]+)%')
+dateRe = re.compile('Finished on (.*?),')
 
-    # maps id to (name, result, solve_date)
-    problems = {}
+class HubParser(object):
+    # incrementally pulls (prob_id, name, result, solve_date) records out of
+    # the orac hub page, one chunk at a time
+    def __init__(self):
+        self.buf = ''
+        self.dates = {}
+
+    def feed(self, chunk):
+        buf = self.buf + chunk
+        end = 0
+        for m in probPattern.finditer(buf):
+            end = m.end()
+            yield self.parse_row(m)
 
-    scoreRe = re.compile('([0-9]+)%')
-    dateRe = re.compile('Finished on (.*?),')
+        # hang on to whatever might be the start of a row we haven't seen the end of
+        start = buf.rfind(probPrefix, end)
+        if start == -1:
+            start = max(end, len(buf) - len(probPrefix))
+        self.buf = buf[start:]
 
-    for m in probResults:
-        setid = m[0]
-        probid = int(m[1])
-        prob_name = m[2].replace('&#39;',"'")
-        status = m[3].strip()
+    def parse_row(self, m):
+        probid = int(m.group(2))
+        prob_name = m.group(3).replace('&#39;',"'")
+        status = m.group(4).strip()
 
-        #problems[probid] = [prob_name, status]
-        sets[setid].append(probid)
-        #if "Finished" not in status:
-        #    setNames[setid][1] = False
         if status.startswith("Finished"):
             result = 100
-            solve_date = datetime.datetime.strptime(dateRe.match(status).group(1), '%a %d %b %Y').date()
+            date_string = dateRe.match(status).group(1)
+            solve_date = self.dates.get(date_string)
+            if not solve_date:
+                solve_date = datetime.datetime.strptime(date_string, '%a %d %b %Y').date()
+                self.dates[date_string] = solve_date
         elif status.startswith("New") or status.startswith("Viewed"):
             result = 0
             solve_date = None
@@ -45,33 +60,297 @@ def get_probs_stats(html_data):
             result = int(scoreRe.match(status).group(1))
             solve_date = None
 
-        problems[probid] = (prob_name, result, solve_date)
+        return probid, prob_name, result, solve_date
+
+def read_chunks(data, size=CHUNK_SIZE):
+    if isinstance(data, basestring):
+        yield data
+        return
+    while True:
+        chunk = data.read(size)
+        if not chunk:
+            break
+        yield chunk
+
+def iter_probs_stats(data):
+    # data is either the page itself or a file-like object (such as the
+    # response from fetch_stats) to read it from
+    parser = HubParser()
+    for chunk in read_chunks(data):
+        for record in parser.feed(chunk):
+            yield record
 
+def get_probs_stats(data):
+    # maps id to (name, result, solve_date)
+    problems = {}
+    for probid, prob_name, result, solve_date in iter_probs_stats(data):
+        problems[probid] = (prob_name, result, solve_date)
     return problems
 
-def fetch_stats(username, password):
-    params = {'login_username': username, 'login_password': password, 'login_submit': 'Log in'}
-
-    conn = httplib.HTTPConnection('orac.amt.edu.au')
-    conn.request('POST', '/cgi-bin/train/index.pl', urllib.urlencode(params))
-    res = conn.getresponse()
-    if res.status == 302 and '?error=1' not in res.getheader('Location'):
-        # extract cookies
-        cookie_header = res.getheader('set-cookie')
-        cookie = '; '.join(re.findall('(aioc_.*?=.*?);', cookie_header))
-        result = True
-    else:
-        result = False
-    conn.close()
-
-    if result:
+ORAC_HOST = 'orac.amt.edu.au'
+# seconds to wait on orac before giving up
+TIMEOUT = 30
+
+class SharedRateLimiter(object):
+    # spaces out calls to wait(), through memcache, across every thread on
+    # every instance: at most rate calls are let through in any one second,
+    # which wait() returns
+    def __init__(self, key, rate):
+        self.key = key
+        self.rate = rate
+
+    def wait(self):
+        from google.appengine.api import memcache
+        while True:
+            now = time.time()
+            second = int(now)
+            key = '%s-%d' % (self.key, second)
+            count = memcache.incr(key)
+            if count is None:
+                # the first call this second
+                if memcache.add(key, 1, time=10):
+                    return second
+                count = memcache.incr(key)
+            if count is None or count <= self.rate:
+                # if memcache is down, don't hold everything up
+                return second
+            time.sleep(second + 1 - now)
+
+class PooledResponse(object):
+    # wraps a response so its connection goes back to the pool once the
+    # body has been read
+    def __init__(self, client, conn, res):
+        self.client = client
+        self.conn = conn
+        self.res = res
+        self.status = res.status
+
+    def getheader(self, name, default=None):
+        return self.res.getheader(name, default)
+
+    def read(self, size=None):
+        data = self.res.read(size) if size else self.res.read()
+        if not size or not data:
+            self.release()
+        return data
+
+    def release(self):
+        if self.conn:
+            if self.res.will_close:
+                self.conn.close()
+            else:
+                self.client.release(self.conn)
+            self.conn = None
+
+    def close(self):
+        # gives up on the rest of the body; the connection can't be reused
+        # with it still unread, so it's closed rather than released
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+class FetchedResponse(object):
+    # a urlfetch result that looks like a PooledResponse; urlfetch reads the
+    # whole body before handing it over, so there's nothing to release
+    def __init__(self, result):
+        self.result = result
+        self.status = result.status_code
+        self.body = result.content
+
+    def getheader(self, name, default=None):
+        return self.result.headers.get(name, default)
+
+    def read(self, size=None):
+        data, self.body = (self.body[:size], self.body[size:]) if size else (self.body, '')
+        return data
+
+    def close(self):
+        self.body = ''
+
+class OracClient(object):
+    # keeps a small pool of keep-alive connections to orac, shared between
+    # threads; this only helps off App Engine, where httplib is a real
+    # socket; on App Engine httplib is built on urlfetch, which makes a new
+    # fetch for every request whatever happens to the connection, so
+    # UrlfetchClient is used there instead
+    def __init__(self, host=ORAC_HOST, timeout=TIMEOUT, pool_size=8):
+        self.host = host
+        self.timeout = timeout
+        self.pool = Queue.Queue(pool_size)
+        self.lock = threading.Lock()
+        self.connections_opened = 0
+
+    def connect(self):
+        with self.lock:
+            self.connections_opened += 1
+        return httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+    def release(self, conn):
+        try:
+            self.pool.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def request(self, method, path, body=None, headers={}):
+        try:
+            conn = self.pool.get_nowait()
+            reused = True
+        except Queue.Empty:
+            conn = self.connect()
+            reused = False
+
+        try:
+            conn.request(method, path, body, headers)
+            res = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            # orac may have closed the idle connection on us, so try once more
+            # on a fresh one
+            conn = self.connect()
+            conn.request(method, path, body, headers)
+            res = conn.getresponse()
+        return PooledResponse(self, conn, res)
+
+    def login(self, username, password):
+        # returns the session cookie for the user, or None if orac won't let them in
+        params = {'login_username': username, 'login_password': password, 'login_submit': 'Log in'}
+
+        res = self.request('POST', '/cgi-bin/train/index.pl', urllib.urlencode(params))
+        res.read()
+        if res.status == 302 and '?error=1' not in res.getheader('Location'):
+            # extract cookies
+            cookie_header = res.getheader('set-cookie')
+            return '; '.join(re.findall('(aioc_.*?=.*?);', cookie_header))
+        return None
+
+    def fetch_hub(self, cookie):
         # use the cookie, luke
-        conn = httplib.HTTPConnection('orac.amt.edu.au')
-        conn.request('GET', '/cgi-bin/train/hub.pl?expand=all&setshowdone=1', None, {'Cookie': cookie})
-        res = conn.getresponse()
+        # the response is handed back unread so it can be parsed as it arrives
+        res = self.request('GET', '/cgi-bin/train/hub.pl?expand=all&setshowdone=1', None, {'Cookie': cookie})
         if res.status == 200:
-            result = res.read()
-        else:
-            result = False
+            return res
+        res.read()
+        return False
+
+    def fetch_many(self, cookies, workers=4, limiter=None):
+        # fetches and parses the hub for every cookie, at most workers at a
+        # time (and no faster than limiter allows, if given); returns a list
+        # in the same order as cookies, holding the stats for each one, False
+        # if orac rejected the cookie, or the exception that was raised
+        results = [None] * len(cookies)
+        todo = Queue.Queue()
+        for i, cookie in enumerate(cookies):
+            todo.put((i, cookie))
+        recorder = instrument.timings.share()
+
+        def work():
+            # the workers' calls count towards the request that started them
+            instrument.timings.join(recorder)
+            while True:
+                try:
+                    i, cookie = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    if limiter:
+                        limiter.wait()
+                    data = self.fetch_hub(cookie)
+                    if data:
+                        try:
+                            with instrument.timed('parse'):
+                                results[i] = get_probs_stats(data)
+                        finally:
+                            data.close()
+                    else:
+                        results[i] = False
+                except Exception, e:
+                    results[i] = e
+
+        threads = [threading.Thread(target=work) for _ in xrange(min(workers, len(cookies)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+class UrlfetchClient(OracClient):
+    # talks to orac through urlfetch directly, for App Engine; fetch_many
+    # keeps several fetches in flight as asynchronous RPCs rather than
+    # tying up a thread for each
+    def request(self, method, path, body=None, headers={}):
+        from google.appengine.api import urlfetch
+        result = urlfetch.fetch('http://%s%s' % (self.host, path), payload=body, method=method, headers=headers,
+            follow_redirects=False, deadline=self.timeout)
+        return FetchedResponse(result)
+
+    def fetch_many(self, cookies, workers=4, limiter=None):
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.api import urlfetch
+        results = [None] * len(cookies)
+        todo = list(enumerate(cookies))
+        todo.reverse()
+        in_flight = dict()
+
+        while todo or in_flight:
+            while todo and len(in_flight) < workers:
+                i, cookie = todo.pop()
+                if limiter:
+                    limiter.wait()
+                rpc = urlfetch.create_rpc(deadline=self.timeout)
+                urlfetch.make_fetch_call(rpc, 'http://%s/cgi-bin/train/hub.pl?expand=all&setshowdone=1' % self.host,
+                    headers={'Cookie': cookie}, follow_redirects=False)
+                in_flight[rpc] = i
+
+            # parse whichever fetch finishes first while the rest carry on
+            rpc = apiproxy_stub_map.UserRPC.wait_any(in_flight.keys())
+            i = in_flight.pop(rpc)
+            try:
+                result = rpc.get_result()
+                if result.status_code == 200:
+                    with instrument.timed('parse'):
+                        results[i] = get_probs_stats(result.content)
+                else:
+                    results[i] = False
+            except Exception, e:
+                results[i] = e
+        return results
+
+def on_app_engine():
+    return os.environ.get('SERVER_SOFTWARE', '').startswith(('Google App Engine/', 'Development/'))
+
+client = UrlfetchClient() if on_app_engine() else OracClient()
+
+def orac_login(username, password):
+    return client.login(username, password)
+
+def fetch_hub(cookie):
+    return client.fetch_hub(cookie)
+
+def fetch_stats(username, password):
+    cookie = orac_login(username, password)
+    if not cookie:
+        return False
+    return fetch_hub(cookie)
+
+def fingerprint_stats(stats):
+    # returns a hash of the whole of stats along with a dict mapping each
+    # problem id to a hash of its row, so later syncs can tell what changed
+    rows = dict()
+    for probid, row in stats.iteritems():
+        rows[probid] = zlib.crc32(repr(row)) & 0xffffffff
+    page_hash = hashlib.sha1(repr(sorted(stats.iteritems()))).hexdigest()
+    return page_hash, rows
+
+def pack_fingerprints(rows):
+    packed = array.array('I')
+    for probid, crc in rows.iteritems():
+        packed.append(probid)
+        packed.append(crc)
+    return packed.tostring()
 
-    return result
+def unpack_fingerprints(data):
+    packed = array.array('I')
+    packed.fromstring(data)
+    return dict(zip(packed[::2], packed[1::2]))
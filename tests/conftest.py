@@ -0,0 +1,107 @@
+# Runs the tests against App Engine's local service stubs. The SDK is found
+# from $APPENGINE_SDK, then from an importable dev_appserver, then from the
+# appengine-sdk package on PyPI.
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if sys.version_info[0] > 2:
+    # the app is Python 2.7 App Engine code
+    collect_ignore_glob = ['test_*.py']
+
+def find_sdk():
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk:
+        return sdk
+    try:
+        import dev_appserver
+        return os.path.dirname(os.path.abspath(dev_appserver.__file__))
+    except ImportError:
+        pass
+    try:
+        import appengine_sdk
+        return os.path.join(os.path.dirname(appengine_sdk.__file__), 'google_appengine')
+    except ImportError:
+        return None
+
+def pytest_configure(config):
+    if sys.version_info[0] > 2:
+        return
+    sys.path.insert(0, ROOT)
+    sdk = find_sdk()
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    os.environ['APPENGINE_RUNTIME'] = 'python27'
+
+@pytest.fixture
+def bed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # queries see every write, unless a test asks otherwise
+    bed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_urlfetch_stub()
+    bed.setup_env(overwrite=True, user_email='', user_id='', user_is_admin='0')
+    yield bed
+    bed.deactivate()
+
+@pytest.fixture
+def app(bed):
+    # main, with its hooks on this test's stubs, nothing left in the
+    # in-process caches from other tests, and jobs run as they're queued
+    import cache
+    import instrument
+    import jobs
+    import main
+
+    instrument.install_hooks()
+    instrument.timings.clear()
+    cache.local.entries.clear()
+    main.memo.clear()
+    runner = jobs.LocalRunner(min_backoff=0)
+    runner.register('/_tasks/sync', main.run_sync)
+    old_runner, main.runner = main.runner, runner
+    yield main
+    main.runner = old_runner
+    main.memo.clear()
+
+def user_id_for(name):
+    # the datastore stub replaces the user id of every User it stores with
+    # one made from the email address, so that's the id users have to have
+    # for them to match the ones read back
+    from google.appengine.datastore import datastore_stub_util
+    return datastore_stub_util.SynthesizeUserId(name + '@example.com')
+
+def user_for(name):
+    from google.appengine.api import users
+    return users.User(name + '@example.com', _user_id=user_id_for(name))
+
+def log_in(bed, name):
+    bed.setup_env(overwrite=True, user_email=name + '@example.com', user_id=user_id_for(name), user_is_admin='0')
+
+@pytest.fixture
+def orac():
+    # a fake orac on a local port, for a small dataset; every password is
+    # 'password' and every session cookie is aioc_session=<username>
+    import threading
+    from bench import Dataset, FakeOrac
+
+    server = FakeOrac(Dataset(users=10, problems=200, per_user=60))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,51 @@
+import json
+import random
+
+from bench import Dataset
+from conftest import user_for, log_in
+
+def get(app, url):
+    from webapp2 import Request
+    return Request.blank(url).get_response(app.app)
+
+def sync_all(app, dataset):
+    for username in dataset.usernames:
+        app.apply_stats(user_for(username), username, dataset.results[username])
+
+def test_feed_needs_login_and_gives_iso_timestamps(app, bed):
+    dataset = Dataset(users=1, problems=10, per_user=10)
+    username = dataset.usernames[0]
+    sync_all(app, dataset)
+    dataset.progress(username, random.Random(0))
+    sync_all(app, dataset)
+
+    assert get(app, '/api/feed').status_int == 401
+    log_in(bed, username)
+    items = json.loads(get(app, '/api/feed').body)['items']
+    assert len(items) == 1
+    assert items[0]['timestamp'].endswith('Z')
+    assert items[0]['text'].startswith(username + ' ')
+
+def test_scores_reports_unknown_users(app, bed):
+    dataset = Dataset(users=2, problems=10, per_user=5)
+    sync_all(app, dataset)
+    log_in(bed, dataset.usernames[0])
+    response = get(app, '/api/scores?users=%s,nobody' % dataset.usernames[1])
+    assert response.status_int == 404
+    assert json.loads(response.body)['users'] == ['nobody']
+    assert get(app, '/api/scores?users=%s' % dataset.usernames[1]).status_int == 200
+
+def test_compare_is_cached_until_a_sync(app, bed):
+    dataset = Dataset(users=2, problems=20, per_user=20)
+    sync_all(app, dataset)
+    first, second = dataset.usernames
+    log_in(bed, first)
+    url = '/api/compare?them=%s' % second
+    before = get(app, url).body
+    assert get(app, url).body == before
+
+    dataset.progress(second, random.Random(0))
+    app.apply_stats(user_for(second), second, dataset.results[second])
+    app.memo.clear()
+    after = json.loads(get(app, url).body)
+    assert after['users'][1]['solved'] == len([1 for name, result, solve_date in dataset.results[second].values() if result == 100])
@@ -0,0 +1,179 @@
+import threading
+import time
+
+import pytest
+
+import cache
+
+class FakeMemcache(object):
+    # just enough of the memcache API for cache.py, backed by a dict; every
+    # write gives the key a new cas id, like the real thing
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = dict()
+        self.writes = 0
+
+    def store(self, key, value):
+        self.writes += 1
+        self.data[key] = (value, self.writes)
+
+    def get(self, key):
+        with self.lock:
+            return self.data.get(key, (None, None))[0]
+
+    def get_multi(self, keys):
+        with self.lock:
+            return dict([(key, self.data[key][0]) for key in keys if key in self.data])
+
+    def set(self, key, value, time=0):
+        with self.lock:
+            self.store(key, value)
+        return True
+
+    def add(self, key, value, time=0):
+        with self.lock:
+            if key in self.data:
+                return False
+            self.store(key, value)
+            return True
+
+    def add_multi(self, mapping, time=0):
+        return [key for key, value in mapping.iteritems() if not self.add(key, value)]
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+        return 2
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+        return True
+
+    def incr(self, key, delta=1, initial_value=None):
+        with self.lock:
+            if key not in self.data:
+                if initial_value is None:
+                    return None
+                self.store(key, initial_value)
+            self.store(key, self.data[key][0] + delta)
+            return self.data[key][0]
+
+    def Client(self):
+        return FakeClient(self)
+
+class FakeClient(object):
+    def __init__(self, memcache):
+        self.memcache = memcache
+        self.cas_ids = dict()
+
+    def gets(self, key):
+        with self.memcache.lock:
+            value, cas_id = self.memcache.data.get(key, (None, None))
+            self.cas_ids[key] = cas_id
+            return value
+
+    def cas(self, key, value, time=0):
+        with self.memcache.lock:
+            if key not in self.memcache.data or self.memcache.data[key][1] != self.cas_ids.pop(key, None):
+                return False
+            self.memcache.store(key, value)
+            return True
+
+@pytest.fixture
+def memcache(monkeypatch):
+    fake = FakeMemcache()
+    monkeypatch.setattr(cache, 'memcache', fake)
+    monkeypatch.setattr(cache, 'local', cache.LRUCache(cache.LOCAL_SIZE))
+    return fake
+
+class Loader(object):
+    def __init__(self, value, delay=0, during=None):
+        self.value = value
+        self.delay = delay
+        self.during = during
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.during:
+            self.during()
+        time.sleep(self.delay)
+        return self.value
+
+def test_miss_fills_and_hit_doesnt_load(memcache):
+    loader = Loader('value')
+    assert cache.get('key', loader) == 'value'
+    assert cache.get('key', loader) == 'value'
+    assert loader.calls == 1
+    assert memcache.get('key') == 'value'
+
+def test_only_one_caller_loads(memcache):
+    loader = Loader('value', delay=0.2)
+    results = list()
+    threads = [threading.Thread(target=lambda: results.append(cache.get('key', loader))) for _ in xrange(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['value'] * 5
+    assert loader.calls == 1
+
+def test_write_through_during_load_wins(memcache):
+    # the loader read the old value before the writer stored the new one
+    loader = Loader('stale', during=lambda: cache.set('key', 'fresh'))
+    cache.get('key', loader)
+    assert memcache.get('key') == 'fresh'
+    assert cache.get('key', Loader('unused')) == 'fresh'
+
+def test_delete_during_load_leaves_key_empty(memcache):
+    loader = Loader('stale', during=lambda: cache.delete('key'))
+    cache.get('key', loader)
+    assert memcache.get('key') is None
+
+def test_failed_load_gives_up_its_lease(memcache):
+    def fail():
+        raise ValueError
+    with pytest.raises(ValueError):
+        cache.get('key', fail)
+    start = time.time()
+    assert cache.get('key', Loader('value')) == 'value'
+    # nobody waited out the lease
+    assert time.time() - start < cache.LEASE_WAIT
+
+def test_waiters_give_up_on_a_stuck_lease(memcache):
+    memcache.add('key', cache.LEASE)
+    loader = Loader('value')
+    assert cache.get('key', loader) == 'value'
+    assert loader.calls == 1
+
+def test_bump_invalidates_namespace(memcache):
+    assert cache.get('key', Loader('old'), namespace='ns') == 'old'
+    cache.bump('ns')
+    assert cache.get('key', Loader('new'), namespace='ns') == 'new'
+
+def test_get_multi_doesnt_replace_write_through(memcache):
+    def loader(missing):
+        cache.set('b', 'fresh')
+        return dict([(key, 'stale') for key in missing])
+    memcache.set('a', 'cached')
+    assert cache.get_multi(['a', 'b'], loader) == {'a': 'cached', 'b': 'stale'}
+    assert memcache.get('b') == 'fresh'
+
+def test_local_tier(memcache):
+    assert cache.get('key', Loader('value'), local_ttl=10) == 'value'
+    memcache.delete('key')
+    # served from the process without asking memcache
+    assert cache.get('key', Loader('unused'), local_ttl=10) == 'value'
+    cache.delete('key')
+    assert cache.get('key', Loader('new'), local_ttl=10) == 'new'
+
+def test_lru_evicts_oldest_and_expires():
+    lru = cache.LRUCache(2)
+    lru.set('a', 1, 10)
+    lru.set('b', 2, 10)
+    lru.get('a')
+    lru.set('c', 3, 10)
+    assert (lru.get('a'), lru.get('b'), lru.get('c')) == (1, None, 3)
+    lru.set('d', 4, -1)
+    assert lru.get('d') is None
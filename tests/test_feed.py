@@ -0,0 +1,50 @@
+import pickle
+
+def test_pickled_deltas_decode_like_json(app):
+    delta = [('Problem %d' % i, -1, 100) for i in xrange(5)]
+    for cut in (0, 3):
+        # pickled deltas had a (None, 0, cut) trailer if anything was cut
+        pickled = pickle.dumps(delta + [(None, 0, cut)] if cut else delta)
+        encoded = app.encode_delta(delta, cut)
+        assert app.decode_delta(pickled) == app.decode_delta(encoded) == (delta, cut)
+        assert len(encoded) < len(pickled)
+
+def post_updates(app, user, count):
+    for i in xrange(count):
+        app.make_status_update(user, [('Problem %d' % i, -1, 100)]).put()
+
+def test_feed_pages_by_cursor(app):
+    from conftest import user_for
+    user = user_for('user0')
+    app.set_orac_username('user0', user)
+    post_updates(app, user, 7)
+
+    seen = list()
+    cursor = None
+    while True:
+        updates, cursor = app.get_feed(cursor, 3)
+        seen.extend(updates)
+        if not cursor:
+            break
+    assert len(seen) == 7
+    assert [timestamp for timestamp, _, _ in seen] == sorted([timestamp for timestamp, _, _ in seen], reverse=True)
+
+    from webapp2 import Request
+    body = Request.blank('/?n=3').get_response(app.app).body
+    assert body.count('user0 solved') == 3
+    assert '/?c=' in body
+
+def test_feed_follows_renames_and_skips_missing_owners(app):
+    from conftest import user_for
+    user = user_for('user0')
+    app.set_orac_username('user0', user)
+    post_updates(app, user, 1)
+    # an old update whose owner never stored a username
+    app.StatusUpdate(owner=user_for('ghost'), delta=app.encode_delta([('Problem 9', -1, 100)], 0)).put()
+
+    updates, _ = app.get_feed(None, 5)
+    assert [(username, achievements) for _, username, achievements in updates] == [('user0', 'solved Problem 0')]
+
+    app.set_orac_username('renamed', user)
+    app.memo.clear()
+    assert [username for _, username, _ in app.get_feed(None, 5)[0]] == ['renamed']
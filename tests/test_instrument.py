@@ -0,0 +1,56 @@
+import threading
+import time
+
+import instrument
+from instrument import timings
+from stats import OracClient
+
+class FakeRPC(object):
+    def __init__(self):
+        self.callback = None
+
+def test_async_calls_are_timed_to_completion():
+    timings.clear()
+    rpc = FakeRPC()
+    called = list()
+    rpc.callback = lambda: called.append(True)
+    instrument.pre_call_hook('datastore_v3', 'Get', None, None, rpc)
+    # the call completes straight away, but its result isn't asked for
+    # until later
+    rpc.callback()
+    time.sleep(0.05)
+    instrument.post_call_hook('datastore_v3', 'Get', None, None)
+    assert called == [True]
+    assert timings.counts['datastore'] == 1
+    assert timings.times['datastore'] < 50
+
+def test_calls_without_rpc_are_timed_by_post_call_hook():
+    timings.clear()
+    response = object()
+    instrument.pre_call_hook('memcache', 'Get', None, response, None)
+    instrument.post_call_hook('memcache', 'Get', None, response)
+    assert timings.counts['memcache'] == 1
+
+def test_stub_calls_are_counted_once(app):
+    timings.clear()
+    key = app.Problem(prob_id=1, name='Problem 1', key_name='1').put()
+    app.db.get_async(key).get_result()
+    assert timings.counts['datastore'] == 2
+
+def test_threads_can_join_a_request():
+    timings.clear()
+    recorder = timings.share()
+
+    def work():
+        timings.join(recorder)
+        timings.add('http', 1.0)
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    assert timings.counts['http'] == 1
+
+def test_fetch_many_workers_count_towards_request(orac):
+    timings.clear()
+    cookies = ['aioc_session=' + username for username in orac.dataset.usernames]
+    OracClient(host=orac.host).fetch_many(cookies, workers=3)
+    assert timings.counts['parse'] == len(cookies)
@@ -0,0 +1,78 @@
+import stats
+from stats import OracClient
+
+def cookie_for(username):
+    return 'aioc_session=' + username
+
+def test_login(orac):
+    client = OracClient(host=orac.host)
+    username = orac.dataset.usernames[0]
+    assert client.login(username, 'password') == cookie_for(username)
+    assert client.login(username, 'wrong') is None
+    assert client.login('nobody', 'password') is None
+
+def test_hub_is_parsed_as_it_is_read(orac):
+    client = OracClient(host=orac.host)
+    for username in orac.dataset.usernames:
+        assert stats.get_probs_stats(client.fetch_hub(cookie_for(username))) == orac.dataset.results[username]
+    assert client.fetch_hub('aioc_session=nobody') is False
+    # every response was read to the end, so the one connection was reused
+    assert orac.connections == 1
+
+def test_fetch_many_reuses_connections(orac):
+    client = OracClient(host=orac.host)
+    cookies = [cookie_for(username) for username in orac.dataset.usernames] * 3 + ['aioc_session=nobody']
+    results = client.fetch_many(cookies, workers=4)
+    assert results == [orac.dataset.results[username] for username in orac.dataset.usernames] * 3 + [False]
+    assert orac.requests == len(cookies)
+    assert orac.connections <= 4
+    assert client.connections_opened == orac.connections
+
+def test_fetch_many_closes_connections_it_gives_up_on(orac, monkeypatch):
+    client = OracClient(host=orac.host)
+
+    def parse(data):
+        data.read(100)
+        raise ValueError('bad page')
+    monkeypatch.setattr(stats, 'get_probs_stats', parse)
+    results = client.fetch_many([cookie_for(username) for username in orac.dataset.usernames], workers=2)
+    assert all([isinstance(result, ValueError) for result in results])
+    # the connections were left part way through a body, so none of them
+    # can go back in the pool
+    assert client.pool.empty()
+
+    monkeypatch.undo()
+    username = orac.dataset.usernames[0]
+    assert client.fetch_many([cookie_for(username)]) == [orac.dataset.results[username]]
+
+def test_urlfetch_client(bed, orac):
+    client = stats.UrlfetchClient(host=orac.host)
+    username = orac.dataset.usernames[0]
+    assert client.login(username, 'password') == cookie_for(username)
+    assert client.login(username, 'wrong') is None
+
+    cookies = [cookie_for(username) for username in orac.dataset.usernames] + ['aioc_session=nobody']
+    results = client.fetch_many(cookies, workers=3)
+    assert results == [orac.dataset.results[username] for username in orac.dataset.usernames] + [False]
+
+def test_shared_rate_limiter(bed):
+    import threading
+
+    # one limiter per thread, as if each were on a different instance
+    returned = list()
+
+    def work():
+        limiter = stats.SharedRateLimiter('test-rate', 5)
+        for _ in xrange(4):
+            returned.append(limiter.wait())
+    threads = [threading.Thread(target=work) for _ in xrange(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    per_second = dict()
+    for second in returned:
+        per_second[second] = per_second.get(second, 0) + 1
+    assert len(returned) == 12
+    assert max(per_second.values()) <= 5
@@ -0,0 +1,95 @@
+from bench import Dataset
+from conftest import user_for, user_id_for, log_in
+
+def get(app, url):
+    from webapp2 import Request
+    return Request.blank(url).get_response(app.app)
+
+def sync_all(app, dataset):
+    for username in dataset.usernames:
+        app.apply_stats(user_for(username), username, dataset.results[username])
+
+def test_problems_lists_the_users_problems(app, bed):
+    dataset = Dataset(users=2, problems=20, per_user=10)
+    sync_all(app, dataset)
+    username = dataset.usernames[0]
+    log_in(bed, username)
+    body = get(app, '/problems').body
+    for prob_id, name in dataset.names.items():
+        assert (('/problem/%d"' % prob_id) in body) == (prob_id in dataset.results[username])
+
+def test_solvers_are_paged_in_order(app, bed, monkeypatch):
+    monkeypatch.setattr(app, 'SOLVERS_PAGE_SIZE', 2)
+    dataset = Dataset(users=5, problems=3, per_user=3)
+    sync_all(app, dataset)
+    log_in(bed, dataset.usernames[0])
+
+    prob_id = 1
+    expected = sorted([(-app.solution_result(result, solve_date), username)
+                       for username in dataset.usernames
+                       for name, result, solve_date in [dataset.results[username][prob_id]]
+                       if app.solution_result(result, solve_date) != -1])
+    listed = list()
+    cursor = None
+    while True:
+        solns, cursor = app.get_solvers(prob_id, cursor, app.SOLVERS_PAGE_SIZE)
+        listed.extend([(-result, username) for username, result in solns])
+        if not cursor:
+            break
+    assert listed == expected
+
+    # a rename moves every one of the user's solutions
+    renamed = dataset.usernames[1]
+    app.apply_stats(user_for(renamed), 'zzz', dataset.results[renamed])
+    usernames = [username for username, result in app.get_solvers(prob_id, None, 10)[0]]
+    assert renamed not in usernames
+    assert ('zzz' in usernames) == (app.solution_result(*dataset.results[renamed][prob_id][1:]) != -1)
+
+    body = get(app, '/problem/%d' % prob_id).body
+    assert 'access to this problem' not in body
+
+def put_summaries(app, totals):
+    summaries = [app.UserSummary(key_name=user_id_for('user%d' % i), owner=user_for('user%d' % i), orac_username='user%d' % i,
+                                 solved=solved, total_score=total_score)
+                 for i, (solved, total_score) in enumerate(totals)]
+    app.db.put(summaries)
+    return summaries
+
+def test_rank_follows_leaderboard_order(app):
+    summaries = put_summaries(app, [(5, 600), (5, 700), (7, 700), (5, 600), (3, 900)])
+    leaderboard = app.get_leaderboard()
+    for summary in summaries:
+        ahead = [other for other in leaderboard if (other.solved, other.total_score) > (summary.solved, summary.total_score)]
+        assert app.get_rank(summary) == (len(ahead) + 1, True)
+
+    # the table numbers ties the same way
+    ranks = dict([(summary.orac_username, rank) for rank, summary in app.rank_leaderboard(leaderboard)])
+    for summary in summaries:
+        assert ranks[summary.orac_username] == app.get_rank(summary)[0]
+    assert sorted(ranks.values()) == [1, 2, 3, 3, 5]
+
+def test_rank_is_capped(app, bed, monkeypatch):
+    monkeypatch.setattr(app, 'RANK_LIMIT', 2)
+    summaries = put_summaries(app, [(7, 700), (6, 700), (5, 800), (5, 600)])
+    assert app.get_rank(summaries[2]) == (3, False)
+    assert app.get_rank(summaries[3]) == (3, False)
+    assert app.get_rank(summaries[1]) == (2, True)
+
+    app.set_orac_username('user3', user_for('user3'))
+    log_in(bed, 'user3')
+    assert 'below #2' in get(app, '/leaderboard').body
+
+def test_summaries_are_built_by_migration(app):
+    from webapp2 import Request
+    dataset = Dataset(users=3, problems=20, per_user=10)
+    sync_all(app, dataset)
+    # as if they'd all synced before summaries were kept
+    app.db.delete(app.UserSummary.all(keys_only=True).fetch(10))
+
+    Request.blank('/_admin/build-summaries', POST={}).get_response(app.app)
+    for username in dataset.usernames:
+        summary = app.UserSummary.get_by_key_name(user_for(username).user_id())
+        results = dataset.results[username].values()
+        assert summary.orac_username == username
+        assert summary.solved == len([1 for name, result, solve_date in results if result == 100])
+        assert summary.total_score == sum([result for name, result, solve_date in results])
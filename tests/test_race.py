@@ -0,0 +1,20 @@
+from bench import Dataset, race
+from conftest import user_for
+
+def test_racing_claims_and_syncs(app):
+    dataset = Dataset(users=8, problems=30, per_user=20, prefix='racer')
+    won, lost, failures = race(app, dataset, user_for, threads=4)
+    assert failures == []
+    assert len(won) == len(dataset.usernames)
+    assert len(lost) == len(dataset.usernames)
+
+def test_legacy_usernames_are_reserved_by_migration(app):
+    from webapp2 import Request
+    holder, other = user_for('holder'), user_for('other')
+    app.UserData(key_name=holder.user_id(), owner=holder, orac_username='taken').put()
+    assert app.UsernameReservation.get_by_key_name('taken') is None
+
+    Request.blank('/_admin/reserve-usernames', POST={}).get_response(app.app)
+    assert app.UsernameReservation.get_by_key_name('taken').owner.user_id() == holder.user_id()
+    assert not app.reserve_username('taken', other)
+    assert app.reserve_username('taken', holder)
@@ -0,0 +1,29 @@
+import StringIO
+
+from microbench import hub_page, regex_probs_stats
+from stats import get_probs_stats
+
+# every size up to 64, then either side of each power of two up to CHUNK_SIZE
+CHUNK_SIZES = sorted(set(range(1, 65) + [size + d for size in [2**i for i in xrange(6, 15)] for d in (-1, 0, 1)]))
+
+class Chunked(object):
+    # hands out the page size bytes at a time, however much is asked for
+    def __init__(self, page, size):
+        self.data = StringIO.StringIO(page)
+        self.size = size
+
+    def read(self, n):
+        return self.data.read(self.size)
+
+def test_parser_matches_regex_at_every_chunk_size():
+    page = hub_page(300)
+    assert len(page) > CHUNK_SIZES[-1]
+    expected = regex_probs_stats(page)
+    assert len(expected) == 300
+    for size in CHUNK_SIZES:
+        stats = get_probs_stats(Chunked(page, size))
+        assert stats == expected, 'chunks of %d bytes' % size
+
+def test_parser_takes_whole_page():
+    page = hub_page(50, seed=1)
+    assert get_probs_stats(page) == regex_probs_stats(page)
@@ -0,0 +1,290 @@
+import datetime
+import random
+
+import instrument
+from bench import Dataset
+from conftest import user_for
+
+def datastore_calls(func, *args):
+    instrument.timings.clear()
+    func(*args)
+    return instrument.timings.counts.get('datastore', 0)
+
+def test_upload_makes_batched_calls(app):
+    # an upload batches its reads and writes, so it makes a handful of calls
+    # per transaction rather than per problem; creating a problem and its
+    # aggregate takes two of a cross-group transaction's groups, so the
+    # first upload of a problem costs the most
+    dataset = Dataset(users=2, problems=400, per_user=300)
+    first, second = dataset.usernames
+    calls = datastore_calls(app.apply_stats, user_for(first), first, dataset.results[first])
+    assert calls < 400
+
+    # the second user's problems mostly exist already
+    calls = datastore_calls(app.apply_stats, user_for(second), second, dataset.results[second])
+    assert calls < 300
+
+def test_unchanged_upload_stops_at_fingerprint(app):
+    dataset = Dataset(users=1, problems=100, per_user=50)
+    username = dataset.usernames[0]
+    user = user_for(username)
+    app.apply_stats(user, username, dataset.results[username])
+    app.memo.clear()
+    instrument.timings.clear()
+    assert not app.apply_stats(user, username, dataset.results[username])
+    assert instrument.timings.counts.get('datastore', 0) == 1
+
+def test_small_change_is_cheap(app):
+    dataset = Dataset(users=1, problems=400, per_user=300)
+    username = dataset.usernames[0]
+    user = user_for(username)
+    app.apply_stats(user, username, dataset.results[username])
+    app.memo.clear()
+    dataset.progress(username, random.Random(0))
+    calls = datastore_calls(app.apply_stats, user, username, dataset.results[username])
+    # the sync's own transaction, then one for each kind of pending change
+    assert calls <= 35
+
+    solutions = app.get_solutions_for_user(user)
+    assert sorted([(soln.prob_id, soln.result, soln.solve_date) for soln in solutions]) == \
+        sorted([(prob_id, result, solve_date) for prob_id, (name, result, solve_date) in dataset.results[username].items()])
+
+def test_pending_changes_apply_once(app, monkeypatch):
+    dataset = Dataset(users=1, problems=50, per_user=30)
+    username = dataset.usernames[0]
+    user = user_for(username)
+
+    # the sync dies after its transaction, before the daily counts land
+    def fail(user, dates):
+        raise RuntimeError('instance went away')
+    apply_pending_days = app.apply_pending_days
+    monkeypatch.setattr(app, 'apply_pending_days', fail)
+    try:
+        app.apply_stats(user, username, dataset.results[username])
+    except RuntimeError:
+        pass
+    assert app.db.get(app.pending_key(user)).days
+
+    # the retry replays what's left, and only that
+    monkeypatch.setattr(app, 'apply_pending_days', apply_pending_days)
+    app.apply_pending(user)
+    app.apply_pending(user)
+    assert app.db.get(app.pending_key(user)) is None
+    solved = len([1 for name, result, solve_date in dataset.results[username].values() if result == 100 and solve_date])
+    assert sum([day.solves for day in app.DailySolves.all()]) == solved
+    assert sum([stats.solved for stats in app.ProblemStats.all()]) == \
+        len([1 for name, result, solve_date in dataset.results[username].values() if result == 100])
+
+class QueueRecorder(object):
+    def __init__(self):
+        self.queued = list()
+
+    def enqueue(self, url, params):
+        self.queued.append((url, params))
+
+def test_queue_sync_refuses_while_one_is_on_the_way(app):
+    app.runner = QueueRecorder()
+    user = user_for('user0')
+    assert app.queue_sync(user, 'user0', 'aioc_session=user0')
+    assert not app.queue_sync(user, 'user0', 'aioc_session=user0')
+    assert len(app.runner.queued) == 1
+
+    # a finished sync doesn't hold up the next
+    app.set_sync_status(user.user_id(), 'success')
+    assert app.queue_sync(user, 'user0', 'aioc_session=user0')
+
+def test_resync_starts_once(app):
+    from webapp2 import Request
+    assert Request.blank('/_tasks/resync').get_response(app.app).body == 'Re-sync started.'
+    assert Request.blank('/_tasks/resync').get_response(app.app).body == 'Re-sync already running.'
+
+def store_legacy_solutions(app, user, username, results):
+    # what a user who hasn't synced since solutions were packed has stored
+    app.UserData(key_name=user.user_id(), owner=user, orac_username=username).put()
+    app.db.put([app.Problem(prob_id=prob_id, name=name, key_name=app.problem_key_name(prob_id))
+                for prob_id, (name, result, solve_date) in results.items()])
+    app.db.put([app.Solution(prob_id=prob_id, owner=user, result=result, solve_date=solve_date,
+                             key_name=app.solution_key_name(prob_id, user))
+                for prob_id, (name, result, solve_date) in results.items()])
+
+def expected_solutions(results):
+    return sorted([(prob_id, result, solve_date) for prob_id, (name, result, solve_date) in results.items()])
+
+def test_legacy_solutions_are_packed_by_migration(app):
+    from webapp2 import Request
+    dataset = Dataset(users=1, problems=50, per_user=30)
+    username = dataset.usernames[0]
+    user = user_for(username)
+    store_legacy_solutions(app, user, username, dataset.results[username])
+
+    # reading finds them, but doesn't store anything
+    solutions = app.get_solutions_for_user(user)
+    assert sorted([(soln.prob_id, soln.result, soln.solve_date) for soln in solutions]) == expected_solutions(dataset.results[username])
+    assert app.UserSolutions.get_by_key_name(user.user_id()) is None
+
+    Request.blank('/_admin/pack-solutions', POST={}).get_response(app.app)
+    app.memo.clear()
+    solutions = app.get_solutions_for_user(user)
+    assert sorted([(soln.prob_id, soln.result, soln.solve_date) for soln in solutions]) == expected_solutions(dataset.results[username])
+
+def test_legacy_solutions_are_packed_by_sync(app):
+    dataset = Dataset(users=1, problems=50, per_user=30)
+    username = dataset.usernames[0]
+    user = user_for(username)
+    store_legacy_solutions(app, user, username, dataset.results[username])
+    app.get_solutions_for_user(user)
+
+    dataset.progress(username, random.Random(0))
+    app.apply_stats(user, username, dataset.results[username])
+    app.memo.clear()
+    solutions = app.get_solutions_for_user(user)
+    assert sorted([(soln.prob_id, soln.result, soln.solve_date) for soln in solutions]) == expected_solutions(dataset.results[username])
+
+def expected_problem_stats(app, dataset, prob_id):
+    counts = dict()
+    for username in dataset.usernames:
+        if prob_id in dataset.results[username]:
+            name, result, solve_date = dataset.results[username][prob_id]
+            listed = app.solution_result(result, solve_date)
+            counts[listed] = counts.get(listed, 0) + 1
+    return counts
+
+def test_problem_stats_are_summed_from_shards(app):
+    dataset = Dataset(users=12, problems=5, per_user=5)
+    rng = random.Random(0)
+    for username in dataset.usernames:
+        app.apply_stats(user_for(username), username, dataset.results[username])
+    for username in dataset.usernames[:6]:
+        dataset.progress(username, rng)
+        app.apply_stats(user_for(username), username, dataset.results[username])
+
+    # the users' changes went to more than one shard
+    assert app.ProblemStats.all().count() > 5
+    for prob_id in dataset.names:
+        app.memo.clear()
+        stats = app.get_problem_stats(prob_id)
+        counts = expected_problem_stats(app, dataset, prob_id)
+        assert stats.unattempted == counts.get(-1, 0)
+        assert stats.solved == counts.get(100, 0)
+        assert [stats.scores[result] for result in xrange(101)] == [counts.get(result, 0) for result in xrange(101)]
+
+def test_legacy_problem_stats_are_built_by_migration(app):
+    from webapp2 import Request
+    dataset = Dataset(users=3, problems=3, per_user=3)
+    for username in dataset.usernames:
+        app.apply_stats(user_for(username), username, dataset.results[username])
+    # as if the aggregate predated the sync
+    app.db.delete(app.ProblemStats.all(keys_only=True).fetch(100))
+    app.cache.delete('problemstats-1')
+    app.memo.clear()
+    # viewing the problem doesn't build it
+    assert app.get_problem_stats(1).unattempted + app.get_problem_stats(1).solved + app.get_problem_stats(1).unsolved == 0
+    assert app.ProblemStats.all().count() == 0
+
+    Request.blank('/_admin/build-problem-stats', POST={}).get_response(app.app)
+    app.memo.clear()
+    assert app.get_problem_stats(1).unattempted + app.get_problem_stats(1).solved + app.get_problem_stats(1).unsolved == 3
+    # running it again changes nothing
+    Request.blank('/_admin/build-problem-stats', POST={}).get_response(app.app)
+    assert app.ProblemStats.all().count() == len(dataset.names)
+
+    # changes are applied on top of what was built
+    username = dataset.usernames[0]
+    dataset.progress(username, random.Random(1))
+    app.apply_stats(user_for(username), username, dataset.results[username])
+    app.memo.clear()
+    counts = expected_problem_stats(app, dataset, 1)
+    assert app.get_problem_stats(1).scores[100] == counts.get(100, 0)
+    assert app.get_problem_stats(1).unattempted == counts.get(-1, 0)
+
+def test_daily_solves_are_summed_from_shards(app):
+    dataset = Dataset(users=12, problems=20, per_user=10)
+    for username in dataset.usernames:
+        app.apply_stats(user_for(username), username, dataset.results[username])
+
+    solves = dict()
+    for username in dataset.usernames:
+        for name, result, solve_date in dataset.results[username].values():
+            if result == 100 and solve_date:
+                solves[solve_date] = solves.get(solve_date, 0) + 1
+    assert app.DailySolves.all().count() > len(solves)
+    assert app.get_site_progress() == app.weekly_totals(solves)
+
+def test_problem_stats_version_changes_with_every_write(app):
+    dataset = Dataset(users=2, problems=1, per_user=1)
+    versions = list()
+    for username in dataset.usernames:
+        app.apply_stats(user_for(username), username, dataset.results[username])
+        app.memo.clear()
+        versions.append(app.get_problem_stats(1).version)
+    # however close together the writes are
+    assert versions[0] < versions[1]
+
+def test_compare_with_unpacked_users(app, bed):
+    from webapp2 import Request
+    from conftest import log_in
+    dataset = Dataset(users=2, problems=20, per_user=10)
+    first, second = dataset.usernames
+    app.apply_stats(user_for(first), first, dataset.results[first])
+    store_legacy_solutions(app, user_for(second), second, dataset.results[second])
+    # someone who'd stored a username but had no solutions
+    app.UserData(key_name=user_for('empty').user_id(), owner=user_for('empty'), orac_username='empty').put()
+
+    log_in(bed, first)
+    response = Request.blank('/compare?them=empty').get_response(app.app)
+    assert response.status_int == 200
+    assert '0/0' in response.body
+
+    solved = len([1 for name, result, solve_date in dataset.results[second].values() if result == 100])
+    response = Request.blank('/compare?them=%s' % second).get_response(app.app)
+    assert response.status_int == 200
+    assert '%d/%d' % (solved, len(dataset.results[second])) in response.body
+
+def test_resync_after_a_failed_apply_finishes_it(app, monkeypatch):
+    dataset = Dataset(users=1, problems=20, per_user=10)
+    username = dataset.usernames[0]
+    user = user_for(username)
+
+    # the sync's transaction commits, fingerprint and all, then it dies
+    def fail(user):
+        raise RuntimeError('instance went away')
+    apply_pending = app.apply_pending
+    monkeypatch.setattr(app, 'apply_pending', fail)
+    try:
+        app.apply_stats(user, username, dataset.results[username])
+    except RuntimeError:
+        pass
+    monkeypatch.setattr(app, 'apply_pending', apply_pending)
+
+    # the retry sees the same page, but still applies what's pending
+    assert not app.apply_stats(user, username, dataset.results[username])
+    assert app.db.get(app.pending_key(user)) is None
+    assert app.db.get(app.fingerprint_key(user)).orac_username == username
+
+def test_overlapping_syncs_keep_fingerprint_and_solutions_together(app, monkeypatch):
+    import copy
+    dataset = Dataset(users=1, problems=30, per_user=20)
+    username = dataset.usernames[0]
+    user = user_for(username)
+    first = copy.deepcopy(dataset.results[username])
+    app.apply_stats(user, username, first)
+    dataset.progress(username, random.Random(0))
+    second = copy.deepcopy(dataset.results[username])
+    assert second != first
+
+    # a sync of the second page lands after this one read the fingerprint,
+    # but before its transaction
+    insert_problems = app.insert_problems
+    def overlap(problems):
+        monkeypatch.setattr(app, 'insert_problems', insert_problems)
+        app.apply_stats(user, username, second)
+        insert_problems(problems)
+    monkeypatch.setattr(app, 'insert_problems', overlap)
+    third = dict(first)
+    prob_id = min([prob_id for prob_id, (name, result, solve_date) in first.items() if result < 100])
+    third[prob_id] = (first[prob_id][0], 100, datetime.date(2020, 1, 1))
+    app.apply_stats(user, username, third)
+
+    app.memo.clear()
+    solutions = app.get_solutions_for_user(user)
+    assert sorted([(soln.prob_id, soln.result, soln.solve_date) for soln in solutions]) == expected_solutions(third)